@@ -0,0 +1,248 @@
+"""
+Async ACRCloud identify client
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import time
+import uuid
+
+from tornado.gen import coroutine, Return, with_timeout, TimeoutError
+from tornado.http1connection import HTTP1Connection, HTTP1ConnectionParameters
+from tornado.httputil import HTTPHeaders, HTTPMessageDelegate, RequestStartLine
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.locks import Semaphore
+from tornado.tcpclient import TCPClient
+
+from recognition import Cancelled, on_cancel
+
+try:
+    from acrcloud import acrcloud_extr_tool
+except ImportError:
+    from acrcloud_osx import acrcloud_extr_tool
+
+_IDENTIFY_PATH = '/v1/identify'
+
+
+FINGERPRINT_RATE = 8000
+
+
+def fingerprint(pcm):
+    """
+    Returns ACRCloud fingerprint of the first 12 seconds of 16 bit mono PCM
+    at FINGERPRINT_RATE, None if it couldn't be fingerprinted
+    """
+
+    return acrcloud_extr_tool.create_fingerprint(pcm[:12 * FINGERPRINT_RATE * 2], False) or None
+
+
+def _close_connected(connecting):
+    if connecting.exception() is None:
+        connecting.result().close()
+
+
+class _Response(HTTPMessageDelegate):
+    def __init__(self):
+        self.code = None
+        self.chunks = []
+
+    def headers_received(self, start_line, headers):
+        self.code = start_line.code
+
+    def data_received(self, chunk):
+        self.chunks.append(chunk)
+
+    @property
+    def body(self):
+        return b''.join(self.chunks)
+
+
+class ACRCloudClient(object):
+    """
+    Identifies fingerprints over at most max_connections keep-alive
+    connections, requests wait for a free connection. A request taking
+    more than timeout seconds, failing or cancelled closes its connection
+    before freeing it.
+    """
+
+    def __init__(self, host, access_key, access_secret, timeout=10, max_connections=10):
+        self.host = host
+        self.access_key = access_key
+        self.access_secret = access_secret
+        self.timeout = timeout
+
+        self._tcp_client = TCPClient()
+        self._semaphore = Semaphore(max_connections)
+        self._idle = []
+
+    def _sign(self, timestamp):
+        string_to_sign = '\n'.join([
+            'POST',
+            _IDENTIFY_PATH,
+            self.access_key,
+            'fingerprint',
+            '1',
+            str(timestamp),
+        ])
+
+        return base64.b64encode(
+            hmac.new(str(self.access_secret), string_to_sign, digestmod=hashlib.sha1).digest()
+        )
+
+    def _multipart(self, fingerprint):
+        """
+        Returns (boundary, list of body parts), the fingerprint is one of the
+        parts as is so it's never copied into a joined body
+        """
+
+        boundary = uuid.uuid4().hex
+        timestamp = int(time.time())
+
+        fields = [
+            ('access_key', self.access_key),
+            ('sample_bytes', str(len(fingerprint))),
+            ('timestamp', str(timestamp)),
+            ('signature', self._sign(timestamp)),
+            ('data_type', 'fingerprint'),
+            ('signature_version', '1'),
+        ]
+
+        parts = [
+            '--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(boundary, k, v)
+            for k, v in fields
+        ]
+
+        parts.append(
+            '--{}\r\nContent-Disposition: form-data; name="sample"; filename="sample"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n'.format(boundary)
+        )
+        parts.append(fingerprint)
+        parts.append('\r\n--{}--\r\n'.format(boundary))
+
+        return boundary, parts
+
+    @coroutine
+    def _get_stream(self, deadline):
+        while self._idle:
+            stream = self._idle.pop()
+            stream.set_close_callback(None)
+
+            if not stream.closed():
+                raise Return((stream, True))
+
+        connecting = self._tcp_client.connect(self.host, 80)
+
+        try:
+            stream = yield with_timeout(deadline, connecting, quiet_exceptions=StreamClosedError)
+        except TimeoutError:
+            # connect() can't be cancelled, close the connection once it's made
+            IOLoop.current().add_future(connecting, _close_connected)
+            raise
+
+        raise Return((stream, False))
+
+    def _release_stream(self, stream):
+        if stream.closed():
+            return
+
+        # drop the connection from the pool if the server closes it while idle
+        stream.set_close_callback(lambda: stream in self._idle and self._idle.remove(stream))
+        self._idle.append(stream)
+
+    @coroutine
+    def _post(self, stream, parts, headers):
+        connection = HTTP1Connection(stream, True, HTTP1ConnectionParameters())
+        response = _Response()
+
+        connection.write_headers(RequestStartLine('POST', _IDENTIFY_PATH, 'HTTP/1.1'), headers)
+
+        for part in parts:
+            connection.write(part)
+
+        connection.finish()
+
+        # closes the stream unless the server keeps the connection alive
+        yield connection.read_response(response)
+        raise Return(response)
+
+    @coroutine
+    def _request(self, stream, parts, headers, deadline, cancel):
+        """
+        Posts over stream, closing it on failure, once deadline passed or
+        once cancel resolves
+        """
+
+        io_loop = IOLoop.current()
+        timeout = io_loop.call_at(deadline, stream.close)
+        disarm = on_cancel(cancel, stream.close)
+
+        try:
+            response = yield self._post(stream, parts, headers)
+        except StreamClosedError:
+            if cancel is not None and cancel.done():
+                raise Cancelled()
+
+            if io_loop.time() >= deadline:
+                raise TimeoutError('acrcloud request timed out')
+
+            raise
+        except Exception:
+            stream.close()
+            raise
+        finally:
+            io_loop.remove_timeout(timeout)
+            disarm()
+
+        raise Return(response)
+
+    @coroutine
+    def _identify(self, fingerprint, cancel):
+        deadline = IOLoop.current().time() + self.timeout
+        boundary, parts = self._multipart(fingerprint)
+
+        headers = HTTPHeaders({
+            'Host': self.host,
+            'Content-Type': 'multipart/form-data; boundary={}'.format(boundary),
+            'Content-Length': str(sum(len(part) for part in parts)),
+        })
+
+        stream, reused = yield self._get_stream(deadline)
+
+        try:
+            response = yield self._request(stream, parts, headers, deadline, cancel)
+        except StreamClosedError:
+            if not reused:
+                raise
+
+            # the server closed the idle connection as we reused it
+            stream, _ = yield self._get_stream(deadline)
+            response = yield self._request(stream, parts, headers, deadline, cancel)
+
+        self._release_stream(stream)
+
+        if response.code != 200:
+            raise RuntimeError('acrcloud responded with {}'.format(response.code))
+
+        raise Return(json.loads(response.body))
+
+    @coroutine
+    def identify(self, fingerprint, cancel=None):
+        """
+        Returns ACRCloud identify response for fingerprint, raises Cancelled
+        once cancel resolves
+        """
+
+        yield self._semaphore.acquire()
+
+        try:
+            if cancel is not None and cancel.done():
+                raise Cancelled()
+
+            res = yield self._identify(fingerprint, cancel)
+        finally:
+            self._semaphore.release()
+
+        raise Return(res)
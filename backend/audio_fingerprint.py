@@ -0,0 +1,240 @@
+"""
+Local audio fingerprints that survive re-recording
+
+Spectral peaks are picked from the spectrogram after Ellis' audfprint: a
+peak must rise above a threshold that every kept peak raises around its
+frequency and that decays over time, so a sustained note gives a single
+peak at its onset and loud bands don't take every peak. Pairs of nearby
+peaks are hashed from their frequencies and time difference, after Wang's
+Shazam landmarks.
+
+Two recordings of the same part of a track share many landmarks at a
+single time offset, crowd noise and echo only hide some of them. Tracks
+built on the same beat share a few landmarks at every offset, spread
+evenly, so a match must stand out from the other offsets rather than
+merely reach a count.
+"""
+
+from base64 import b64decode, b64encode
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+RATE = 8000
+
+_WINDOW = 512
+_HOP = 128
+
+# bins of about 60 Hz to 3.5 kHz, crowd rumble and what's left above the
+# resampling low pass are ignored
+_LOW_BIN = 4
+_HIGH_BIN = 224
+
+# a kept peak raises the threshold by a parabola in log magnitude, _SPREAD
+# bins wide, the threshold then decays by _DECAY per frame
+_SPREAD = 32.0
+_DECAY = np.log(0.98)
+_PEAKS_PER_FRAME = 4
+
+# each peak is paired with the next _FAN peaks at most _MAX_DT frames later
+# and _MAX_DF bins away
+_FAN = 3
+_MAX_DT = 63
+_MAX_DF = 48
+
+# half of the landmarks are kept, picked by hash so every recording keeps
+# the same ones
+_KEEP = 2
+
+FRAME_SECONDS = float(_HOP) / RATE
+
+_HANNING = np.hanning(_WINDOW).astype(np.float32)
+_BINS = np.arange(_HIGH_BIN - _LOW_BIN)
+
+# how much a peak at each bin raises the threshold of every bin
+_MASKS = 0.5 * ((_BINS[None, :] - _BINS[:, None]) / _SPREAD) ** 2
+
+
+class Fingerprint(object):
+    """
+    Landmark hashes, sorted, with the frame they start at, of a recording
+    frames long
+    """
+
+    __slots__ = ('hashes', 'times', 'frames')
+
+    def __init__(self, hashes, times, frames):
+        self.hashes = hashes
+        self.times = times
+        self.frames = frames
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def dump(self):
+        """
+        Returns a json-able fingerprint, load() reads it back
+        """
+
+        return {
+            'hashes': b64encode(self.hashes.astype('<u4').tostring()),
+            'times': b64encode(self.times.astype('<u2').tostring()),
+            'frames': self.frames,
+        }
+
+    @classmethod
+    def load(cls, dumped):
+        return cls(
+            np.frombuffer(b64decode(dumped['hashes']), '<u4').astype(np.uint32),
+            np.frombuffer(b64decode(dumped['times']), '<u2').astype(np.uint16),
+            dumped['frames'],
+        )
+
+
+def _spectrogram(samples):
+    frames = 1 + (len(samples) - _WINDOW) // _HOP
+
+    if frames <= 0:
+        return np.zeros((0, len(_BINS)), np.float32)
+
+    # overlapping windows as views of samples
+    windows = as_strided(samples, (frames, _WINDOW), (_HOP * samples.itemsize, samples.itemsize))
+    windows = windows * _HANNING
+    magnitude = np.abs(np.fft.rfft(windows, axis=1))[:, _LOW_BIN:_HIGH_BIN]
+
+    # floored 120 dB under the loudest bin so digital silence has no peaks
+    log_magnitude = np.log(np.maximum(magnitude, magnitude.max() * 1e-6 + 1e-3))
+    return log_magnitude - log_magnitude.mean()
+
+
+def _peaks(spectrogram):
+    """
+    Returns (frames, bins) of the spectral peaks
+    """
+
+    if not len(spectrogram):
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+
+    local_max = np.ones(spectrogram.shape, bool)
+    local_max[:, 1:] &= spectrogram[:, 1:] >= spectrogram[:, :-1]
+    local_max[:, :-1] &= spectrogram[:, :-1] >= spectrogram[:, 1:]
+
+    candidate_frames, candidate_bins = np.nonzero(local_max)
+    bounds = np.searchsorted(candidate_frames, np.arange(len(spectrogram) + 1))
+
+    # the threshold at frame t is base + _DECAY * t, levels are raised by
+    # -_DECAY * t instead so only kept peaks update base
+    base = spectrogram[:10].max(axis=0)
+    times, bins = [], []
+
+    for t in xrange(len(spectrogram)):
+        candidates = candidate_bins[bounds[t]:bounds[t + 1]]
+        levels = spectrogram[t, candidates] - _DECAY * t
+        above = levels - base[candidates]
+        picked = np.argsort(-above)[:_PEAKS_PER_FRAME]
+
+        for f, level, margin in zip(candidates[picked], levels[picked], above[picked]):
+            # an earlier peak of this frame might have masked it
+            if margin <= 0 or level <= base[f]:
+                continue
+
+            times.append(t)
+            bins.append(f)
+            base = np.maximum(base, level - _MASKS[f])
+
+    return np.array(times, np.int64), np.array(bins, np.int64)
+
+
+def _pairs(times, bins):
+    """
+    Returns (hashes, times) of the landmarks made of each peak and the
+    following ones, built for the k-th following peak of every peak at once
+    """
+
+    hashes, starts = [], []
+    paired = np.zeros(len(times), np.int64)
+
+    for k in xrange(1, len(times)):
+        anchors = np.nonzero(paired[:-k] < _FAN)[0]
+        dt = times[anchors + k] - times[anchors]
+
+        # peaks are in time order, later ones are even further
+        anchors, dt = anchors[dt <= _MAX_DT], dt[dt <= _MAX_DT]
+
+        if not len(anchors):
+            break
+
+        df = bins[anchors + k] - bins[anchors]
+        pairable = (dt > 0) & (np.abs(df) <= _MAX_DF)
+        anchors, dt, df = anchors[pairable], dt[pairable], df[pairable]
+
+        hashes.append(bins[anchors] << 13 | (df + _MAX_DF) << 6 | dt)
+        starts.append(times[anchors])
+        paired[anchors] += 1
+
+    if not hashes:
+        return np.zeros(0, np.uint32), np.zeros(0, np.uint16)
+
+    return np.concatenate(hashes).astype(np.uint32), np.concatenate(starts).astype(np.uint16)
+
+
+def _kept(hashes):
+    return ((hashes.astype(np.uint64) * 2654435761 & 0xffffffff) >> 16) % _KEEP == 0
+
+
+def fingerprint(pcm):
+    """
+    Returns the Fingerprint of 16 bit mono PCM at RATE
+    """
+
+    spectrogram = _spectrogram(np.frombuffer(pcm, '<i2').astype(np.float32))
+    hashes, times = _pairs(*_peaks(spectrogram))
+
+    kept = _kept(hashes)
+    hashes, times = hashes[kept], times[kept]
+    order = np.argsort(hashes, kind='mergesort')
+
+    return Fingerprint(hashes[order], times[order], len(spectrogram))
+
+
+def match(fingerprint, other):
+    """
+    Returns (offset, matches, runner-up matches) where matches is the number
+    of distinct landmarks of fingerprint found in other with frame t of
+    fingerprint aligned with frame t + offset of other, give or take a
+    frame, offset being the best alignment. runner-up matches are those of
+    the best alignment more than 3 frames away.
+    """
+
+    starts = np.searchsorted(other.hashes, fingerprint.hashes, 'left')
+    counts = np.searchsorted(other.hashes, fingerprint.hashes, 'right') - starts
+
+    if not counts.sum():
+        return 0, 0, 0
+
+    # every (landmark of fingerprint, landmark of other) with the same hash
+    mine = np.repeat(np.arange(len(counts)), counts)
+    first = np.cumsum(counts) - counts
+    theirs = np.repeat(starts - first, counts) + np.arange(counts.sum())
+
+    offsets = other.times[theirs].astype(np.int64) - fingerprint.times[mine]
+    hashes = fingerprint.hashes[mine].astype(np.int64)
+
+    # distinct hashes per offset, each counted at its neighbours too
+    shift = -offsets.min() + 1
+    keys = np.unique(np.concatenate([(offsets + shift + d) << 32 | hashes for d in (-1, 0, 1)]))
+    votes = np.bincount(keys >> 32)
+
+    best = votes.argmax()
+    away = np.abs(np.arange(len(votes)) - best) > 3
+    runner_up = votes[away].max() if away.any() else 0
+
+    return int(best - shift), int(votes[best]), int(runner_up)
+
+
+def overlap(fingerprint, other, offset):
+    """
+    Returns how many frames fingerprint and other share at offset
+    """
+
+    return max(0, min(fingerprint.frames, other.frames - offset) - max(0, -offset))
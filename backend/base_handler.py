@@ -1,13 +1,15 @@
-from tornado.web import RequestHandler
+from tornado.web import RequestHandler, HTTPError
 from chainmap import ChainMap
+import hashlib
 import logging
 import jwt
 
 class CORSHandler(RequestHandler):
     def get_token(self):
-        secret = self.settings['jwt_secret']
-        token = self.get_argument('token') 
-        return jwt.decode(token, secret, algorithms=['HS256'])
+        if not hasattr(self, '_token'):
+            self._token = self.settings['tokens'].decode(self.get_argument('token'))
+
+        return self._token
 
     def create_token(self, data):
         secret = self.settings['jwt_secret']
@@ -16,15 +18,51 @@ class CORSHandler(RequestHandler):
     def get_club_id(self):
         return self.get_token()['club_id']
 
+    def check_admin(self):
+        if not self.get_token().get('admin', False):
+            raise HTTPError(403)
+
     def set_default_headers(self):
         self.set_header("Access-Control-Allow-Origin", "*")
         self.set_header("Access-Control-Allow-Methods", "GET,PUT,POST,DELETE,OPTIONS")
-        self.set_header("Access-Control-Allow-Headers", "Content-Type, Depth, User-Agent, X-File-Size, X-Requested-With, X-Requested-By, If-Modified-Since, X-File-Name, Cache-Control")
+        self.set_header("Access-Control-Allow-Headers", "Content-Type, Depth, User-Agent, X-File-Size, X-Requested-With, X-Requested-By, If-Modified-Since, If-None-Match, X-File-Name, Cache-Control")
+        self.set_header("Access-Control-Expose-Headers", "ETag")
 
     def options(self, *args, **kwargs):
         self.finish()
 
+    def on_finish(self):
+        self.settings['request_metrics'].observe(
+            self.__class__.__name__,
+            self.request.method,
+            self.get_status(),
+            1000.0 * self.request.request_time(),
+        )
+
 class BaseHandler(CORSHandler):
+    def state_etag(self, *args):
+        """
+        Returns an ETag for the current clubs state and args
+        """
+
+        key = repr((self.settings['clubs'].state_hash(),) + args)
+        return '"{}"'.format(hashlib.sha1(key).hexdigest())
+
+    def finish_if_not_modified(self):
+        """
+        Sets the ETag header and finishes with 304 if it matches If-None-Match,
+        should be called before building the response body
+        """
+
+        self.set_etag_header()
+
+        if self.check_etag_header():
+            self.set_status(304)
+            self.finish()
+            return True
+
+        return False
+
     def get_latlng(self):
         latlng = self.get_argument('latlng', None)
 
@@ -65,3 +103,5 @@ class BaseHandler(CORSHandler):
             logger.error('error', extra=extra, exc_info=True)
         else:
             logger.info('success', extra=extra)
+
+        super(BaseHandler, self).on_finish()
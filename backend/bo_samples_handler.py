@@ -1,9 +1,34 @@
+from tornado.gen import coroutine
+from tornado.web import HTTPError
 from base_handler import CORSHandler
 
 class BOSamplesHandler(CORSHandler):
+    @coroutine
+    def get(self):
+        """
+        Returns the sample history of the club box, newest first, limit
+        samples created before the before sample id at a time
+        """
+
+        try:
+            limit = int(self.get_argument('limit', 50))
+            before = self.get_argument('before', None)
+            before = int(before) if before is not None else None
+        except ValueError:
+            raise HTTPError(400)
+
+        if limit <= 0:
+            raise HTTPError(400)
+
+        club_id = self.get_token()['club_id']
+        box_id = self.settings['clubs'].get_box_id(club_id)
+        samples = (yield self.settings['samples'].history(box_id, limit, before)) if box_id else []
+        self.finish({'samples': samples})
+
+    @coroutine
     def post(self):
         sample_id = int(self.get_argument('sample_id'))
         club_id = self.get_token()['club_id']
         box_id = self.settings['clubs'].get(club_id).get('box_id')
-        self.settings['samples'].toggle_hiddeness(box_id, sample_id)
+        yield self.settings['samples'].toggle_hiddeness(box_id, sample_id)
         self.finish({'success': True, 'error': None})
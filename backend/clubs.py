@@ -1,43 +1,136 @@
 # -*- coding: utf-8 -*-
 
 import copy
+import hashlib
 import os
-import json
 import time
 
+from tornado.escape import json_encode
+from tornado.gen import coroutine
+from tornado.ioloop import IOLoop
+
 from bo_handler import BOHandler
+from geo import GeoIndex
+from clubs_journal import ClubsJournal
 
 _CLUBS_FILE = 'clubs.json'
 
-def _get_clubs():
-    return json.loads(open(_CLUBS_FILE).read())
+
+def _index_boxes(clubs):
+    """
+    Returns dict of box id -> club id
+    """
+
+    index = {}
+
+    for club_id, club in clubs.items():
+        index.setdefault(club['box_id'], club_id)
+
+    return index
+
+
+def _is_stopped(stopper):
+    """
+    Stoppers are 0 when off, -1 until further notice, otherwise the time
+    they're off again
+    """
+
+    return stopper == -1 or stopper > time.time()
 
 
-def _save_clubs(clubs):
-    tmp_clubs_file = '{}.tmp'.format(_CLUBS_FILE)
+def _filter_samples(samples):
+    # samples are serialized for each call so they can be changed in place
+    def remove_recognized_song(sample):
+        if sample['metadata']['keep_unrecognized']:
+            sample['metadata'].pop('recognized_song', None)
 
-    with open(tmp_clubs_file, 'w') as f:
-        f.write(json.dumps(clubs, indent=4))
+        return sample
 
-    os.rename(tmp_clubs_file, _CLUBS_FILE)
+    return [
+        remove_recognized_song(sample)
+        for sample in samples
+        if not sample['metadata']['hidden']
+    ]
+
+
+class PublishedClub(object):
+    """
+    Pre-serialized public view of a club, the per-client distance is
+    appended on serialization
+    """
+
+    __slots__ = ('location', 'last_sample', '_json')
+
+    def __init__(self, club, last_sample):
+        self.location = club['location']
+        self.last_sample = last_sample
+        self._json = json_encode(club)[:-1]
+
+    def serialize(self, distance):
+        return '{}, "distance": {}}}'.format(self._json, distance)
 
 
 class Clubs(object):
     def __init__(self, samples, base_url, images_version):
-        self._clubs = _get_clubs()
+        self.journal = ClubsJournal(_CLUBS_FILE)
+
+        clubs = self.journal.load()
+        self._clubs, self._box_index = clubs, _index_boxes(clubs)
+        self._version = 0
+        self._published = None
+        self._stop_timeouts = {}
 
         self.samples = samples
         self.base_url = base_url
         self.images_version = images_version
 
-    def remove_overdue_stops(self):
-        for club in self._clubs.values():
-            for k in BOHandler._stoppers:
-                if club[k] in (0, -1):
-                    continue
+    def schedule_stops(self):
+        """
+        Schedules the expiry of every stopper with a deadline, overdue ones
+        expire right away. Stoppers past their deadline read as off, expiry
+        only republishes the club.
+        """
+
+        for club_id in self._clubs.keys():
+            self._schedule_club_stops(club_id)
 
-                if int(time.time()) > club[k]:
-                    club[k] = 0
+    def _schedule_club_stops(self, club_id):
+        for k in BOHandler._stoppers:
+            deadline = self._clubs[club_id][k]
+            key = club_id, k
+            scheduled = self._stop_timeouts.get(key)
+
+            if scheduled is not None and scheduled[0] == deadline:
+                continue
+
+            if scheduled is not None:
+                IOLoop.current().remove_timeout(scheduled[1])
+                del self._stop_timeouts[key]
+
+            # 0 is off and -1 is until further notice
+            if deadline in (0, -1):
+                continue
+
+            timeout = IOLoop.current().call_later(
+                max(0, deadline - time.time()),
+                self._expire_stop, club_id, k, deadline,
+            )
+
+            self._stop_timeouts[key] = deadline, timeout
+
+    def _expire_stop(self, club_id, stopper, deadline):
+        # not written back as off, another process might have extended it
+        # since this one last synced
+        del self._stop_timeouts[club_id, stopper]
+        self._version += 1
+
+    @property
+    def version(self):
+        """
+        Changes whenever clubs or their samples change
+        """
+
+        return self._version + self.samples.version
 
     def get_box_id(self, club_id):
         return self._clubs[club_id].get('box_id')
@@ -45,9 +138,13 @@ class Clubs(object):
     def get(self, club_id):
         club = copy.deepcopy(self._clubs[club_id])
 
+        for k in BOHandler._stoppers:
+            if not _is_stopped(club[k]):
+                club[k] = 0
+
         club['club_id'] = club_id
         club['logo'] = self.get_logo(club_id)
-        club['samples'] = self.samples.all().get(club['box_id'])
+        club['samples'] = self.samples.get(club['box_id'])
         club['cover'] = os.path.join(
             self.get_images_path(),
             club_id,
@@ -59,11 +156,106 @@ class Clubs(object):
     def all(self):
         return [self.get(club_id) for club_id in self._clubs.keys()]
 
+    def published(self):
+        """
+        Returns the published clubs, rebuilt only when the version changes
+        """
+
+        return self._get_published()[0]
+
+    def published_index(self):
+        """
+        Returns a GeoIndex of the published clubs by location
+        """
+
+        return self._get_published()[1]
+
+    def state_hash(self):
+        """
+        Returns a hash of the published clubs and the latest sample of every
+        club. Unlike the version it's the same in every process and across
+        restarts for the same state.
+        """
+
+        return self._get_published()[2]
+
+    def _get_published(self):
+        version = self.version
+
+        if self._published is None or self._published[0] != version:
+            clubs = tuple(self._publish())
+            index = GeoIndex((club.location, club) for club in clubs)
+            self._published = version, (clubs, index, self._hash_state(clubs))
+
+        return self._published[1]
+
+    def _hash_state(self, published):
+        state = hashlib.sha1()
+
+        for club in published:
+            state.update(club.serialize(0))
+
+        # /health also reports clubs that aren't published
+        for club_id, club in sorted(self._clubs.items()):
+            latest = self.samples.latest(club['box_id'])
+            state.update(repr((club_id, latest and latest['_created'])))
+
+        return state.hexdigest()
+
+    def _publish(self):
+        for club_id in self._clubs.keys():
+            club = self.get(club_id)
+
+            if club['stopPublishing'] != 0 or not club['samples']:
+                continue
+
+            last_sample = club['samples'][0]['_created']
+            club['samples'] = _filter_samples(club['samples'])
+            club['location__'] = club['location']
+
+            # remove hidden fields
+            for k in club.keys():
+                if k.startswith('_'):
+                    del club[k]
+
+            yield PublishedClub(club, last_sample)
+
     def update(self, club_id, club):
-        clubs = copy.deepcopy(self._clubs)
-        clubs[club_id].update(club)
-        _save_clubs(clubs)
-        self._clubs = clubs
+        # copy on write of the updated club only, readers holding the
+        # previous clubs keep a consistent view
+        updated = dict(self._clubs[club_id])
+        updated.update(club)
+
+        clubs = dict(self._clubs)
+        clubs[club_id] = updated
+
+        # the index is built before the swap so it always matches _clubs
+        box_index = self._box_index
+
+        if updated['box_id'] != self._clubs[club_id]['box_id']:
+            box_index = _index_boxes(clubs)
+
+        self._clubs, self._box_index = clubs, box_index
+        self._version += 1
+
+        self.journal.record(club_id, club)
+        self._schedule_club_stops(club_id)
+
+    @coroutine
+    def sync(self):
+        """
+        Picks up changes persisted by other processes
+        """
+
+        clubs = yield self.journal.reload()
+
+        if clubs is None:
+            return
+
+        self._clubs, self._box_index = clubs, _index_boxes(clubs)
+        self._version += 1
+
+        self.schedule_stops()
 
     def get_logo(self, club):
         sizes = 'hdpi', 'mdpi', 'xhdpi', 'xxhdpi', 'xxxhdpi'
@@ -84,17 +276,25 @@ class Clubs(object):
         )
         
     def find_club_by_box_id(self, box_id):
-        # FIXME yeah it's o(n) but n is very small 
-        # so this should do for now, lookup table in the future
+        club_id = self._box_index.get(box_id)
+
+        if club_id is not None:
+            return self._clubs[club_id]
+
+    def hold_states(self):
+        """
+        Returns whether each stopper is on for each club
+        """
+
+        return {
+            club_id: {k: _is_stopped(club[k]) for k in BOHandler._stoppers}
+            for club_id, club in self._clubs.items()
+        }
 
-        for club in self._clubs.values():
-            if club['box_id'] == box_id:
-                return club
-    
     def is_recording_on_hold(self, box_id):
         club = self.find_club_by_box_id(box_id)
-        return club and club['stopRecording'] != 0
+        return club and _is_stopped(club['stopRecording'])
 
     def is_recognition_on_hold(self, box_id):
         club = self.find_club_by_box_id(box_id)
-        return club and club['stopRecognition'] != 0
+        return club and _is_stopped(club['stopRecognition'])
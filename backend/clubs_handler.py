@@ -1,60 +1,69 @@
-from operator import itemgetter
-import copy
 import time
-from geopy import distance
+from tornado.web import HTTPError
 from base_handler import BaseHandler
 
 
 def is_club_not_live(club):
-    last_sample_dt = time.time() - club['samples'][0]["_created"]
+    last_sample_dt = time.time() - club.last_sample
     return last_sample_dt > 600
 
 
 class ClubsHandler(BaseHandler):
-    def get_distance_from_client(self, location):
-        client_latlng = self.get_latlng()
+    def get_number_argument(self, name, type_):
+        value = self.get_argument(name, None)
 
-        if client_latlng is None:
-            return 0
+        if value is None:
+            return
+
+        try:
+            value = type_(value)
+        except ValueError:
+            raise HTTPError(400, 'invalid {}'.format(name))
 
-        return int(distance.vincenty(location, client_latlng).meters)
+        if value < 0:
+            raise HTTPError(400, 'invalid {}'.format(name))
 
-    def filtered_samples(self, samples):
-        def remove_recognized_song(sample):
-            sample = copy.deepcopy(sample)
+        return value
+
+    def get_clubs_with_distance(self):
+        """
+        Returns (distance, club) of published clubs, within radius meters
+        from the client if radius is given
+        """
+
+        clubs = self.settings['clubs']
+        client_latlng = self.get_latlng()
+        radius = self.get_number_argument('radius', float)
 
-            if sample['metadata']['keep_unrecognized']:
-                del sample['metadata']['recognized_song']
+        if client_latlng is None:
+            return [(0, club) for club in clubs.published()]
 
-            return sample
+        if radius is None:
+            return clubs.published_index().distances(client_latlng)
 
-        return [
-            remove_recognized_song(sample)
-            for sample in samples
-            if not sample['metadata']['hidden']
-        ]
+        return clubs.published_index().nearby(client_latlng, radius)
 
     def get_clubs(self):
-        clubs = [
-            club
-            for club in self.settings['clubs'].all()
-            if club['stopPublishing'] == 0 and club['samples']
-        ]
-
-        for club in clubs:
-            club['samples'] = self.filtered_samples(club['samples'])
-            club['distance'] = self.get_distance_from_client(club['location'])
-            club['location__'] = club['location']
-
-            # remove hidden fields
-            for k in club.keys():
-                if k.startswith('_'):
-                    del club[k]
-
-        return sorted(
-            sorted(clubs, key=itemgetter('distance')),
-            key=is_club_not_live
+        clubs = sorted(
+            self.get_clubs_with_distance(),
+            key=lambda (distance, club): (is_club_not_live(club), distance)
+        )
+
+        return clubs[:self.get_number_argument('limit', int)]
+
+    def compute_etag(self):
+        return self.state_etag(
+            self.get_latlng(),
+            self.get_argument('radius', None),
+            self.get_argument('limit', None),
+            tuple(is_club_not_live(club) for club in self.settings['clubs'].published()),
         )
 
     def get(self):
-        self.finish({'clubs': self.get_clubs()})
+        if self.finish_if_not_modified():
+            return
+
+        clubs = ', '.join(club.serialize(distance) for distance, club in self.get_clubs())
+
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.finish('{"clubs": [' + clubs + ']}')
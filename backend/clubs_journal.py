@@ -0,0 +1,194 @@
+"""
+Write-behind persistence of clubs
+"""
+
+import json
+import logging
+import os
+
+from tornado.gen import coroutine, Return
+from tornado.ioloop import IOLoop
+from persistence import io_executor, append_file, write_file_atomically, read_json, flocked
+
+
+def _read_clubs(path, journal_path):
+    """
+    Returns (clubs from path with the journal replayed on top, journal entries)
+    """
+
+    clubs = read_json(path)
+    entries = 0
+
+    if not os.path.exists(journal_path):
+        return clubs, entries
+
+    with open(journal_path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # torn write of the last entry
+                break
+
+            clubs[entry['club_id']].update(entry['changes'])
+            entries += 1
+
+    return clubs, entries
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    return st.st_mtime, st.st_size
+
+
+class ClubsJournal(object):
+    """
+    Changes to a club are coalesced for flush_delay seconds then appended
+    to path.journal, one fsync per batch. The journal is compacted into
+    path every compact_interval seconds or once it has compact_size entries.
+
+    Several processes can share the files: appends and compactions hold a
+    lock on path.lock, and a compaction writes what's on disk rather than
+    the clubs of the process running it.
+    """
+
+    def __init__(self, path, flush_delay=1.0, compact_interval=60, compact_size=1000):
+        self.path = path
+        self.journal_path = '{}.journal'.format(path)
+        self.lock_path = '{}.lock'.format(path)
+        self.flush_delay = flush_delay
+        self.compact_interval = compact_interval
+        self.compact_size = compact_size
+
+        self._pending = {}
+        self._in_flight = []
+        self._journal_size = 0
+        self._seen = None
+        self._flush_timeout = None
+        self._compact_timeout = None
+
+    def _files_state(self):
+        return _stat(self.path), _stat(self.journal_path)
+
+    def load(self):
+        """
+        Returns clubs from path with the journal replayed on top
+        """
+
+        self._seen = self._files_state()
+        clubs, self._journal_size = _read_clubs(self.path, self.journal_path)
+        return clubs
+
+    def _load_if_changed(self):
+        state = self._files_state()
+
+        if state == self._seen:
+            return None
+
+        self._seen = state
+        return _read_clubs(self.path, self.journal_path)[0]
+
+    @coroutine
+    def reload(self):
+        """
+        Returns clubs if the files changed since they were last read, None
+        otherwise. Changes not appended yet when the files were read are
+        applied on top.
+        """
+
+        clubs = yield io_executor.submit(self._load_if_changed)
+
+        if clubs is not None:
+            # reapplying changes appended since the files were read is harmless
+            for pending in self._in_flight + [self._pending]:
+                for club_id, changes in pending.items():
+                    clubs[club_id].update(changes)
+
+        raise Return(clubs)
+
+    def record(self, club_id, changes):
+        """
+        Schedules persisting changes to club_id
+        """
+
+        self._pending.setdefault(club_id, {}).update(changes)
+
+        if self._flush_timeout is None:
+            self._flush_timeout = IOLoop.current().call_later(self.flush_delay, self.flush)
+
+    def _take_pending(self):
+        """
+        Returns the pending changes, kept in flight until appended
+        """
+
+        pending, self._pending = self._pending, {}
+        self._in_flight.append(pending)
+        self._journal_size += len(pending)
+        return pending
+
+    def _append(self, pending):
+        lines = ''.join(
+            json.dumps({'club_id': club_id, 'changes': changes}) + '\n'
+            for club_id, changes in pending.items()
+        )
+
+        with flocked(self.lock_path):
+            append_file(self.journal_path, lines)
+
+    def _compact(self):
+        with flocked(self.lock_path):
+            clubs, _ = _read_clubs(self.path, self.journal_path)
+            write_file_atomically(self.path, json.dumps(clubs, indent=4))
+
+            # a crash before the truncation replays changes clubs.json
+            # already has, replaying them again is harmless
+            open(self.journal_path, 'wb').close()
+
+    @coroutine
+    def flush(self):
+        if self._flush_timeout is not None:
+            IOLoop.current().remove_timeout(self._flush_timeout)
+            self._flush_timeout = None
+
+        if not self._pending:
+            return
+
+        pending = self._take_pending()
+        appended = io_executor.submit(self._append, pending)
+
+        if self._journal_size >= self.compact_size:
+            self.compact()
+        elif self._compact_timeout is None:
+            self._compact_timeout = IOLoop.current().call_later(self.compact_interval, self.compact)
+
+        try:
+            yield appended
+        except Exception:
+            logging.getLogger('logstash-logger').exception('could not append to clubs journal')
+        finally:
+            self._in_flight.remove(pending)
+
+    @coroutine
+    def compact(self):
+        if self._compact_timeout is not None:
+            IOLoop.current().remove_timeout(self._compact_timeout)
+            self._compact_timeout = None
+
+        self._journal_size = 0
+
+        try:
+            yield io_executor.submit(self._compact)
+        except Exception:
+            logging.getLogger('logstash-logger').exception('could not compact clubs journal')
+
+    def close(self):
+        """
+        Writes pending changes synchronously, once the IOLoop stopped
+        """
+
+        if self._pending:
+            io_executor.submit(self._append, self._take_pending()).result()
@@ -0,0 +1,35 @@
+"""
+Decodes samples once into PCM shared by all recognizers
+"""
+
+import audioop
+import subprocess
+
+RATE = 44100
+SAMPLE_WIDTH = 2
+
+
+def decode(path):
+    """
+    Returns the audio in path as 16 bit signed little endian mono PCM at RATE
+    """
+
+    return subprocess.check_output([
+        'sox', path,
+        '-t', 'raw',
+        '-r', str(RATE),
+        '-b', str(8 * SAMPLE_WIDTH),
+        '-c', '1',
+        '-e', 'signed-integer',
+        '-L',
+        '-',
+    ])
+
+
+def resample(pcm, rate):
+    """
+    Resamples PCM returned by decode() to rate
+    """
+
+    pcm, _ = audioop.ratecv(pcm, SAMPLE_WIDTH, 1, RATE, rate, None)
+    return pcm
@@ -0,0 +1,92 @@
+"""
+Geo index for distance sorted club listings
+"""
+
+from collections import defaultdict
+from math import radians, sin, cos, asin, sqrt, floor
+
+_EARTH_RADIUS = 6371008.8
+_METERS_PER_DEGREE = 111195.0
+
+
+class _Point(object):
+    __slots__ = ('lat', 'cos_lat', 'lng', 'value')
+
+    def __init__(self, location, value):
+        lat, lng = location
+        self.lat = radians(lat)
+        self.cos_lat = cos(self.lat)
+        self.lng = radians(lng)
+        self.value = value
+
+
+class GeoIndex(object):
+    """
+    Grid bucket index of (location, value) pairs, trigonometry of the indexed
+    locations is precomputed so a distance is a handful of float operations
+    """
+
+    def __init__(self, items, cell_size=0.05):
+        self.cell_size = cell_size
+
+        self._points = [_Point(location, value) for location, value in items]
+        self._cells = defaultdict(list)
+
+        for point in self._points:
+            self._cells[self._cell(point.lat, point.lng)].append(point)
+
+    def __len__(self):
+        return len(self._points)
+
+    def _cell(self, lat, lng):
+        return (
+            int(floor(lat / radians(self.cell_size))),
+            int(floor(lng / radians(self.cell_size))),
+        )
+
+    def _distances(self, location, points):
+        """
+        Haversine distance in meters from location to each of the points
+        """
+
+        lat, lng = map(radians, location)
+        cos_lat = cos(lat)
+
+        for p in points:
+            h = sin((p.lat - lat) / 2) ** 2 + cos_lat * p.cos_lat * sin((p.lng - lng) / 2) ** 2
+            yield int(2 * _EARTH_RADIUS * asin(min(1.0, sqrt(h)))), p.value
+
+    def _candidates(self, location, radius):
+        lat_span = radius / _METERS_PER_DEGREE
+        lng_span = lat_span / max(cos(radians(location[0])), 0.01)
+
+        min_lat, min_lng = self._cell(radians(location[0] - lat_span), radians(location[1] - lng_span))
+        max_lat, max_lng = self._cell(radians(location[0] + lat_span), radians(location[1] + lng_span))
+
+        if (max_lat - min_lat + 1) * (max_lng - min_lng + 1) > len(self._cells):
+            return self._points
+
+        return [
+            point
+            for cell_lat in xrange(min_lat, max_lat + 1)
+            for cell_lng in xrange(min_lng, max_lng + 1)
+            for point in self._cells.get((cell_lat, cell_lng), ())
+        ]
+
+    def distances(self, location):
+        """
+        Returns (distance, value) for every indexed value
+        """
+
+        return list(self._distances(location, self._points))
+
+    def nearby(self, location, radius):
+        """
+        Returns (distance, value) for values at most radius meters away
+        """
+
+        return [
+            (distance, value)
+            for distance, value in self._distances(location, self._candidates(location, radius))
+            if distance <= radius
+        ]
@@ -0,0 +1,112 @@
+"""
+Pool of long lived gracetune workers (tools/gracetune_worker.py)
+"""
+
+from datetime import timedelta
+import json
+import logging
+
+from tornado.gen import coroutine, Return, with_timeout, TimeoutError
+from tornado.iostream import StreamClosedError
+from tornado.process import Subprocess
+from tornado.queues import Queue
+
+from recognition import Cancelled, on_cancel
+
+
+class _Worker(object):
+    def __init__(self, args):
+        self.alive = True
+        self.killed = False
+        self.proc = Subprocess(args, stdin=Subprocess.STREAM, stdout=Subprocess.STREAM)
+        self.proc.set_exit_callback(self._on_exit)
+
+    def _on_exit(self, returncode):
+        if not self.killed:
+            logging.getLogger('logstash-logger').warning(
+                'gracenote worker %d exited with %d', self.proc.pid, returncode
+            )
+
+        self.alive = False
+
+    @coroutine
+    def run(self, job, data):
+        self.proc.stdin.write(json.dumps(job) + '\n')
+        yield self.proc.stdin.write(data)
+        res = yield self.proc.stdout.read_until('\n')
+        raise Return(json.loads(res))
+
+    def kill(self):
+        self.killed = True
+
+        try:
+            self.proc.proc.kill()
+        except OSError:
+            pass
+
+
+class GracenotePool(object):
+    """
+    Runs at most size recognitions at once, a job waiting for a worker or
+    running for longer than timeout seconds fails, workers that time out,
+    die or run a cancelled job are replaced
+    """
+
+    def __init__(self, gn_config, size, timeout):
+        self.gn_config = gn_config
+        self.size = size
+        self.timeout = timeout
+
+        self._idle = Queue()
+
+    def start(self):
+        for _ in xrange(self.size):
+            self._idle.put_nowait(self._spawn())
+
+    def _spawn(self):
+        return _Worker([
+            'tools/gracetune_worker.py',
+            '--client-id', self.gn_config['client_id'],
+            '--user-id', self.gn_config['user_id'],
+            '--license', self.gn_config['license'],
+        ])
+
+    @coroutine
+    def identify(self, pcm, rate, channels=1, cancel=None):
+        """
+        Returns gracetune_identify.py result for 16 bit PCM, raises Cancelled
+        once cancel resolves, killing the worker running the job
+        """
+
+        timeout = timedelta(seconds=self.timeout)
+        worker = yield self._idle.get(timeout=timeout)
+
+        if not worker.alive:
+            worker = self._spawn()
+
+        if cancel is not None and cancel.done():
+            self._idle.put_nowait(worker)
+            raise Cancelled()
+
+        # killing the worker closes its stdout, failing the job
+        disarm = on_cancel(cancel, worker.kill)
+
+        try:
+            res = yield with_timeout(
+                timeout,
+                worker.run({'pcm_bytes': len(pcm), 'rate': rate, 'channels': channels}, pcm),
+                quiet_exceptions=StreamClosedError,
+            )
+        except (TimeoutError, StreamClosedError):
+            worker.kill()
+            worker = self._spawn()
+
+            if cancel is not None and cancel.done():
+                raise Cancelled()
+
+            raise
+        finally:
+            disarm()
+            self._idle.put_nowait(worker)
+
+        raise Return(res)
@@ -18,7 +18,13 @@ class HealthHandler(BaseHandler):
             for club in self.settings['clubs'].all()
         }
 
+    def compute_etag(self):
+        return self.state_etag(self.get_argument('club_id'))
+
     def get(self):
+        if self.finish_if_not_modified():
+            return
+
         club_id = self.get_argument('club_id')
 
         if club_id == 'all':
@@ -0,0 +1,197 @@
+"""
+Opt-in IOLoop blocking detector (server.py --profile-ioloop)
+"""
+
+from functools import partial
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from tornado.gen import Runner
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+_BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+_MODULE_PATH = os.path.splitext(os.path.abspath(__file__))[0]
+
+
+def _unwrap(callback):
+    """
+    Returns the function under partials and stack_context.wrap() wrappers
+    """
+
+    while True:
+        if isinstance(callback, partial):
+            callback = callback.func
+            continue
+
+        # stack_context wrappers keep the wrapped function in their closure
+        if getattr(callback, '_wrapped', False) and _closure_var(callback, 'fn') is not None:
+            callback = _closure_var(callback, 'fn')
+            continue
+
+        return callback
+
+
+def _closure_var(fn, var):
+    code = getattr(fn, '__code__', None)
+
+    if code is None or var not in code.co_freevars:
+        return None
+
+    return fn.__closure__[code.co_freevars.index(var)].cell_contents
+
+
+def _name(callback):
+    callback = _unwrap(callback)
+    runner = _closure_var(callback, 'self')
+
+    # resumption of a coroutine, named by the coroutine rather than the lambda
+    if isinstance(runner, Runner) and runner.gen is not None:
+        code = runner.gen.gi_code
+        return '{}:{} {}'.format(os.path.basename(code.co_filename), code.co_firstlineno, code.co_name)
+
+    name = getattr(callback, '__name__', repr(callback))
+    owner = getattr(callback, '__self__', None)
+
+    if owner is not None:
+        name = '{}.{}'.format(type(owner).__name__, name)
+
+    return '{}.{}'.format(getattr(callback, '__module__', None), name)
+
+
+def _location(stack):
+    """
+    Innermost frame of our code run by the callback in stack, None if
+    there's none
+    """
+
+    for filename, lineno, function, _ in reversed(stack):
+        path = os.path.abspath(filename)
+
+        # frames below the profiler are the IOLoop and what started it
+        if os.path.splitext(path)[0] == _MODULE_PATH:
+            return None
+
+        if path.startswith(_BACKEND_DIR):
+            return '{}:{} {}'.format(os.path.relpath(path, _BACKEND_DIR), lineno, function)
+
+
+class IOLoopProfiler(object):
+    """
+    Times every IOLoop callback, timeout and fd handler. A watchdog thread
+    samples the stack of the IOLoop thread when a callback runs for longer
+    than threshold seconds, slow callbacks are aggregated by the location
+    they were stuck at and the worst ones logged every dump_interval seconds.
+
+    Only the watchdog runs in another thread, it reads and sets a single
+    attribute each so there's no locking.
+    """
+
+    def __init__(self, threshold=0.05, dump_interval=60, top=10):
+        self.threshold = threshold
+        self.dump_interval = dump_interval
+        self.top = top
+
+        self._io_loop = None
+        self._thread_id = None
+        self._running = None
+        self._sampled = None
+        self._offenders = {}
+
+    def install(self, io_loop=None):
+        """
+        Starts profiling io_loop, fd handlers added before are not timed
+        """
+
+        self._io_loop = io_loop or IOLoop.current()
+        self._thread_id = threading.current_thread().ident
+
+        run_callback = self._io_loop._run_callback
+        add_handler = self._io_loop.add_handler
+
+        self._io_loop._run_callback = lambda callback: self._timed(callback, run_callback, callback)
+        self._io_loop.add_handler = lambda fd, handler, events: add_handler(
+            fd, partial(self._timed, handler, handler), events
+        )
+
+        watchdog = threading.Thread(target=self._watch, name='ioloop-watchdog')
+        watchdog.daemon = True
+        watchdog.start()
+
+        PeriodicCallback(self.dump, 1000 * self.dump_interval, self._io_loop).start()
+
+    def _timed(self, callback, fn, *args):
+        """
+        Runs fn(*args), timed as callback
+        """
+
+        run = (callback, time.time())
+        self._running = run
+
+        try:
+            return fn(*args)
+        finally:
+            self._running = None
+            duration = time.time() - run[1]
+
+            if duration >= self.threshold:
+                self._record(run, duration)
+
+    def _watch(self):
+        while True:
+            time.sleep(self.threshold / 2)
+            run = self._running
+
+            if run is None or time.time() - run[1] < self.threshold:
+                continue
+
+            sampled = self._sampled
+
+            if sampled is not None and sampled[0] is run:
+                continue
+
+            frame = sys._current_frames().get(self._thread_id)
+
+            if frame is not None:
+                self._sampled = (run, traceback.extract_stack(frame))
+
+    def _record(self, run, duration):
+        callback, _ = run
+        sampled = self._sampled
+        stack = sampled[1] if sampled is not None and sampled[0] is run else None
+        key = (stack and _location(stack)) or _name(callback)
+
+        offender = self._offenders.setdefault(key, {
+            'location': key,
+            'count': 0,
+            'total': 0.0,
+            'max': 0.0,
+            'stack': None,
+        })
+
+        offender['count'] += 1
+        offender['total'] += 1000.0 * duration
+
+        if 1000.0 * duration >= offender['max']:
+            offender['max'] = 1000.0 * duration
+            offender['stack'] = stack and traceback.format_list(stack[-15:])
+
+    def dump(self):
+        """
+        Logs the slow callbacks taking the most time since the last dump
+        """
+
+        if not self._offenders:
+            return
+
+        worst = sorted(self._offenders.values(), key=lambda o: o['total'], reverse=True)[:self.top]
+        self._offenders = {}
+
+        logging.getLogger('logstash-logger').warning(
+            'slow ioloop callbacks: %s',
+            ', '.join('{location} ({count}x, max {max:.0f} ms)'.format(**o) for o in worst),
+            extra={'slow_callbacks': worst},
+        )
@@ -0,0 +1,80 @@
+"""
+Logstash handler shipping events from a background thread
+"""
+
+from collections import deque
+import threading
+
+import logstash
+
+
+class AsyncLogstashHandler(logstash.LogstashHandler):
+    """
+    Logging only appends the record to a buffer of at most capacity events,
+    records logged while it's full are dropped and counted. A background
+    thread formats and sends the buffered events every flush_interval
+    seconds, one datagram per event, and once more when closed.
+    """
+
+    def __init__(self, host, port=5959, capacity=10000, flush_interval=1.0, **kwargs):
+        super(AsyncLogstashHandler, self).__init__(host, port, **kwargs)
+
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.dropped = 0
+
+        self._buffer = deque()
+        self._wakeup = threading.Event()
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run, name='logstash-shipper')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, record):
+        if len(self._buffer) >= self.capacity:
+            self.dropped += 1
+            return
+
+        # the record is formatted later in another thread, freeze what the
+        # caller might still change: message arguments and extra dicts
+        try:
+            record.msg = record.getMessage()
+            record.args = ()
+
+            for k, v in record.__dict__.items():
+                if isinstance(v, dict):
+                    record.__dict__[k] = dict(v)
+        except Exception:
+            self.handleError(record)
+            return
+
+        self._buffer.append(record)
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._ship()
+
+        self._ship()
+
+    def _ship(self):
+        while self._buffer:
+            record = self._buffer.popleft()
+
+            try:
+                self.send(self.makePickle(record))
+            except Exception:
+                self.handleError(record)
+
+    def close(self):
+        """
+        Ships the buffered events, called by logging on exit
+        """
+
+        if not self._closed:
+            self._closed = True
+            self._wakeup.set()
+            self._thread.join(10)
+
+        super(AsyncLogstashHandler, self).close()
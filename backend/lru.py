@@ -0,0 +1,51 @@
+"""
+LRU flavour of TTLDict
+"""
+
+from collections import OrderedDict
+
+from ttldict import TTLDict
+
+
+class LRUTTLDict(TTLDict):
+    """
+    TTLDict holding at most max_size keys, least recently used keys are evicted first
+
+    on_remove(key, value) is called for every value leaving the dict,
+    expired, evicted, deleted or replaced
+    """
+
+    def __init__(self, max_size, default_ttl, *args, **kwargs):
+        self._max_size = max_size
+        self._on_remove = kwargs.pop('on_remove', None)
+        super(LRUTTLDict, self).__init__(default_ttl)
+        self._values = OrderedDict()
+        self.update(*args, **kwargs)
+
+    def _removed(self, key, value):
+        if self._on_remove is not None:
+            self._on_remove(key, value)
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            replaced = self._values.pop(key, None)
+            super(LRUTTLDict, self).__setitem__(key, value)
+
+            if replaced is not None:
+                self._removed(key, replaced[1])
+
+            while len(self._values) > self._max_size:
+                evicted, (_expire, evicted_value) = self._values.popitem(last=False)
+                self._removed(evicted, evicted_value)
+
+    def __getitem__(self, key):
+        with self._lock:
+            value = super(LRUTTLDict, self).__getitem__(key)
+            self._values[key] = self._values.pop(key)
+            return value
+
+    def __delitem__(self, key):
+        with self._lock:
+            _expire, value = self._values[key]
+            super(LRUTTLDict, self).__delitem__(key)
+            self._removed(key, value)
@@ -0,0 +1,144 @@
+"""
+In-process latency histograms and request metrics, updated from the IOLoop
+thread only so plain dicts and ints are enough
+"""
+
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+import time
+
+from tornado.ioloop import IOLoop
+
+# upper bounds in ms, the last bucket counts everything slower
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 20000, 30000, 60000)
+
+
+class Histogram(object):
+    """
+    Counts of observations per bucket, cheap enough to update on every request
+    """
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Returns the upper bound of the bucket holding the q quantile,
+        None if there are no observations or it's past the last bucket
+        """
+
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        seen = 0
+
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+
+            if seen >= rank:
+                return bound
+
+        return None
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'avg': self.sum / self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'buckets': dict(zip(map(str, self.buckets) + ['inf'], self.counts)),
+        }
+
+
+class StageLatencies(object):
+    """
+    Latency histograms per stage, overall and per key (box id)
+    """
+
+    def __init__(self):
+        self._all = defaultdict(Histogram)
+        self._by_key = defaultdict(lambda: defaultdict(Histogram))
+
+    def observe(self, key, timings):
+        """
+        Records timings, a dict of stage to ms
+        """
+
+        for stage, ms in timings.items():
+            self._all[stage].observe(ms)
+            self._by_key[key][stage].observe(ms)
+
+    def snapshot(self):
+        return {
+            'all': {stage: h.snapshot() for stage, h in self._all.items()},
+            'boxes': {
+                key: {stage: h.snapshot() for stage, h in stages.items()}
+                for key, stages in self._by_key.items()
+            },
+        }
+
+
+class RequestMetrics(object):
+    """
+    Request counts per handler, method and status and latency per handler
+    """
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.latency = defaultdict(Histogram)
+
+    def observe(self, handler, method, status, ms):
+        self.counts[handler, method, status] += 1
+        self.latency[handler].observe(ms)
+
+
+class IOLoopLag(object):
+    """
+    Measures how late a callback scheduled every interval seconds runs,
+    i.e. how long the IOLoop was blocked
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.last = 0.0
+        self.histogram = Histogram()
+
+        self._expected = None
+
+    def start(self):
+        io_loop = IOLoop.current()
+        self._expected = io_loop.time() + self.interval
+        io_loop.call_at(self._expected, self._measure)
+
+    def _measure(self):
+        self.last = max(0.0, 1000.0 * (IOLoop.current().time() - self._expected))
+        self.histogram.observe(self.last)
+        self.start()
+
+
+@contextmanager
+def timed(timings, stage):
+    """
+    Records in timings how many ms the with block took, also in coroutines
+    where it spans the yields
+    """
+
+    t0 = time.time()
+
+    try:
+        yield
+    finally:
+        timings[stage] = 1000.0 * (time.time() - t0)
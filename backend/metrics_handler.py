@@ -0,0 +1,146 @@
+import os
+
+from base_handler import CORSHandler
+from persistence import io_executor
+from sample_processor import SampleProcessor
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in sorted(labels.items())
+    ))
+
+
+class _Exposition(object):
+    """
+    Prometheus text format writer, labels are added to every sample
+    """
+
+    def __init__(self, **labels):
+        self.labels = labels
+        self.lines = []
+
+    def metric(self, name, type_, help_):
+        self.lines.append('# HELP {} {}'.format(name, help_))
+        self.lines.append('# TYPE {} {}'.format(name, type_))
+
+    def sample(self, name, value, **labels):
+        labels.update(self.labels)
+        self.lines.append('{}{} {}'.format(name, _format_labels(labels), float(value)))
+
+    def histogram(self, name, histogram, **labels):
+        """
+        Writes a metrics.Histogram of ms in seconds
+        """
+
+        cumulative = 0
+
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            self.sample(name + '_bucket', cumulative, le=bound / 1000.0, **labels)
+
+        self.sample(name + '_bucket', histogram.count, le='+Inf', **labels)
+        self.sample(name + '_sum', histogram.sum / 1000.0, **labels)
+        self.sample(name + '_count', histogram.count, **labels)
+
+    def render(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+class MetricsHandler(CORSHandler):
+    """
+    Prometheus metrics, everything is read from in-process counters so
+    samples are labelled with the server process. With --workers each
+    process also serves them on its own --metrics-port.
+    """
+
+    def write_requests(self, out):
+        request_metrics = self.settings['request_metrics']
+
+        out.metric('listenin_http_requests_total', 'counter', 'HTTP requests')
+
+        for (handler, method, status), count in request_metrics.counts.items():
+            out.sample('listenin_http_requests_total', count, handler=handler, method=method, code=status)
+
+        out.metric('listenin_http_request_duration_seconds', 'histogram', 'HTTP request latency')
+
+        for handler, histogram in request_metrics.latency.items():
+            out.histogram('listenin_http_request_duration_seconds', histogram, handler=handler)
+
+    def write_runtime(self, out):
+        ioloop_lag = self.settings['ioloop_lag']
+
+        out.metric('listenin_ioloop_lag_seconds', 'histogram', 'How late IOLoop callbacks run')
+        out.histogram('listenin_ioloop_lag_seconds', ioloop_lag.histogram)
+
+        out.metric('listenin_ioloop_last_lag_seconds', 'gauge', 'Latest IOLoop lag')
+        out.sample('listenin_ioloop_last_lag_seconds', ioloop_lag.last / 1000.0)
+
+        out.metric('listenin_log_events_dropped_total', 'counter', 'Log events dropped while the shipping buffer was full')
+        out.sample('listenin_log_events_dropped_total', self.settings['log_shipper'].dropped)
+
+        out.metric('listenin_thread_pool_queue_depth', 'gauge', 'Jobs waiting for a thread')
+        out.sample('listenin_thread_pool_queue_depth', SampleProcessor._thread_pool._work_queue.qsize(), pool='decode')
+        out.sample('listenin_thread_pool_queue_depth', io_executor._work_queue.qsize(), pool='io')
+
+    def write_recognition(self, out):
+        out.metric('listenin_recognitions_total', 'counter', 'Recognizer calls by outcome')
+
+        for name, stats in self.settings['recognition_stats'].snapshot().items():
+            out.sample('listenin_recognitions_total', stats['hits'], recognizer=name, outcome='hit')
+            out.sample('listenin_recognitions_total', stats['errors'], recognizer=name, outcome='error')
+            out.sample('listenin_recognitions_total', stats['calls'] - stats['hits'] - stats['errors'], recognizer=name, outcome='miss')
+            out.sample('listenin_recognitions_total', stats['cancelled'], recognizer=name, outcome='cancelled')
+
+        cache = self.settings['recognition_cache'].stats()
+
+        out.metric('listenin_recognition_cache_lookups_total', 'counter', 'Recognition cache lookups by result')
+        out.sample('listenin_recognition_cache_lookups_total', cache['hits'], result='hit')
+        out.sample('listenin_recognition_cache_lookups_total', cache['misses'], result='miss')
+
+        out.metric('listenin_recognition_cache_confirmations_total', 'counter', 'Recognition cache hits by whether the recognizer agreed')
+        out.sample('listenin_recognition_cache_confirmations_total', cache['confirmed'], result='confirmed')
+        out.sample('listenin_recognition_cache_confirmations_total', cache['contradicted'], result='contradicted')
+
+        out.metric('listenin_recognition_cache_size', 'gauge', 'Recognitions in memory')
+        out.sample('listenin_recognition_cache_size', cache['size'])
+
+        queue = self.settings['recognition_queue'].stats()
+
+        out.metric('listenin_recognition_queue_depth', 'gauge', 'Samples waiting for recognition')
+        out.sample('listenin_recognition_queue_depth', queue['depth'])
+
+        out.metric('listenin_recognition_queue_busy_workers', 'gauge', 'Workers processing a sample')
+        out.sample('listenin_recognition_queue_busy_workers', queue['busy'])
+
+        out.metric('listenin_recognition_queue_jobs_total', 'counter', 'Samples by outcome')
+
+        for outcome in 'enqueued', 'replayed', 'rejected', 'processed', 'failed':
+            out.sample('listenin_recognition_queue_jobs_total', queue[outcome], outcome=outcome)
+
+    def write_clubs(self, out):
+        out.metric('listenin_box_samples', 'gauge', 'Cached samples per box')
+
+        for box_id, size in self.settings['samples'].sizes().items():
+            out.sample('listenin_box_samples', size, box=box_id)
+
+        out.metric('listenin_club_on_hold', 'gauge', 'Whether a stopper is on for a club')
+
+        for club_id, states in self.settings['clubs'].hold_states().items():
+            for stopper, on_hold in states.items():
+                out.sample('listenin_club_on_hold', on_hold, club=club_id, stopper=stopper)
+
+    def get(self):
+        out = _Exposition(worker=self.settings['worker'], pid=os.getpid())
+
+        self.write_requests(out)
+        self.write_runtime(out)
+        self.write_recognition(out)
+        self.write_clubs(out)
+
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.finish(out.render())
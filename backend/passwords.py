@@ -0,0 +1,80 @@
+"""
+Back office password checks off the IOLoop
+"""
+
+import hashlib
+import hmac
+import time
+
+import bcrypt
+from concurrent.futures import ProcessPoolExecutor
+from tornado.gen import coroutine, Return
+from lru import LRUTTLDict
+
+
+class RateLimited(Exception):
+    pass
+
+
+def check_password(plain_text_password, hashed_password):
+    return bcrypt.checkpw(
+        plain_text_password.encode('utf-8'),
+        hashed_password.encode('utf-8')
+    )
+
+
+class PasswordVerifier(object):
+    """
+    Runs bcrypt in a pool of workers processes. Verified credentials are
+    cached for cache_ttl seconds under an HMAC of username, password and hash
+    so the cache holds no passwords and forgets a user whose hash changed.
+    A user gets at most max_attempts bcrypt checks per window seconds.
+    """
+
+    def __init__(self, secret, workers=2, cache_ttl=5*60, cache_size=1000, max_attempts=5, window=60):
+        self.secret = secret
+        self.max_attempts = max_attempts
+        self.window = window
+
+        self._executor = ProcessPoolExecutor(workers)
+        self._verified = LRUTTLDict(cache_size, cache_ttl)
+        self._attempts = {}
+
+    def _key(self, username, password, hashed_password):
+        msg = u'\0'.join([username, password, hashed_password]).encode('utf-8')
+        return hmac.new(str(self.secret), msg, hashlib.sha256).digest()
+
+    def _allow(self, username):
+        now = time.time()
+        started, attempts = self._attempts.get(username, (now, 0))
+
+        if now - started >= self.window:
+            started, attempts = now, 0
+
+        if attempts >= self.max_attempts:
+            return False
+
+        self._attempts[username] = (started, attempts + 1)
+        return True
+
+    @coroutine
+    def verify(self, username, password, hashed_password):
+        """
+        Returns whether password matches hashed_password, raises RateLimited
+        when username ran out of attempts
+        """
+
+        key = self._key(username, password, hashed_password)
+
+        if key in self._verified:
+            raise Return(True)
+
+        if not self._allow(username):
+            raise RateLimited()
+
+        ok = yield self._executor.submit(check_password, password, hashed_password)
+
+        if ok:
+            self._verified[key] = True
+
+        raise Return(ok)
@@ -0,0 +1,99 @@
+"""
+Disk persistence off the IOLoop thread
+"""
+
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+# A single thread keeps writes to the same file in submission order
+io_executor = ThreadPoolExecutor(1)
+
+
+def write_file(path, data):
+    """
+    Writes data to path in place, readers might see a partially written file
+    """
+
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def write_file_atomically(path, data):
+    """
+    Writes data to a temporary file and renames it over path once it's on disk
+    """
+
+    tmp_path = '{}.tmp'.format(path)
+    write_file(tmp_path, data)
+    commit_file(tmp_path, path)
+
+
+def commit_file(tmp_path, path):
+    """
+    Flushes tmp_path to disk and renames it to path
+    """
+
+    fd = os.open(tmp_path, os.O_RDONLY)
+
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    os.rename(tmp_path, path)
+
+
+def append_file(path, data):
+    """
+    Appends data to path and flushes it to disk
+    """
+
+    with open(path, 'ab') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.loads(f.read())
+
+
+def unlink_if_exists(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+@contextmanager
+def flocked(path):
+    """
+    Holds an exclusive lock on path, shared with other processes, blocks
+    until it's free so should only be used off the IOLoop thread
+    """
+
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def try_flock(path):
+    """
+    Returns a file descriptor holding an exclusive lock on path, None if
+    another process holds it. Closing the descriptor releases the lock.
+    """
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        os.close(fd)
+        return None
+
+    return fd
@@ -0,0 +1,194 @@
+"""
+Strategies for running several recognizers on a sample
+
+sequential: next recognizer starts only after the previous one failed
+race: all recognizers start together, first success wins
+hedged: next recognizer starts after a delay or once the previous one failed
+"""
+
+from collections import defaultdict
+from functools import partial
+import logging
+import time
+
+from tornado.concurrent import Future
+from tornado.gen import coroutine, Return
+from tornado.ioloop import IOLoop
+
+STRATEGIES = ('sequential', 'race', 'hedged')
+
+
+class Cancelled(Exception):
+    """
+    Raised by a recognizer aborted since another one succeeded
+    """
+
+
+def on_cancel(cancel, callback):
+    """
+    Calls callback() once cancel, a Future or None, resolves unless the
+    returned function was called before
+    """
+
+    if cancel is None:
+        return lambda: None
+
+    armed = [True]
+
+    def fire(_):
+        if armed[0]:
+            callback()
+
+    def disarm():
+        armed[0] = False
+
+    cancel.add_done_callback(fire)
+    return disarm
+
+
+class RecognizerStats(object):
+    """
+    Per recognizer calls, hits, errors and latency
+    """
+
+    def __init__(self):
+        self._stats = defaultdict(lambda: {
+            'calls': 0,
+            'hits': 0,
+            'errors': 0,
+            'cancelled': 0,
+            'latency': 0.0,
+        })
+
+    def record(self, name, latency, hit=False, error=False):
+        stats = self._stats[name]
+        stats['calls'] += 1
+        stats['hits'] += int(hit)
+        stats['errors'] += int(error)
+        stats['latency'] += latency
+
+    def record_cancelled(self, name):
+        self._stats[name]['cancelled'] += 1
+
+    def snapshot(self):
+        """
+        Returns stats per recognizer with hit rate and average latency in ms
+        """
+
+        return {
+            name: dict(
+                stats,
+                hit_rate=stats['hits'] / float(stats['calls']) if stats['calls'] else None,
+                avg_latency=1000.0 * stats['latency'] / stats['calls'] if stats['calls'] else None,
+            )
+            for name, stats in self._stats.items()
+        }
+
+
+def _first_done(futures, timeout=None):
+    """
+    Returns a Future resolving to the first of futures to finish,
+    or to None if timeout seconds pass first
+    """
+
+    first = Future()
+
+    def on_done(f):
+        if not first.done():
+            first.set_result(f)
+
+    for f in futures:
+        f.add_done_callback(on_done)
+
+    if timeout is not None:
+        IOLoop.current().call_later(timeout, lambda: on_done(None))
+
+    return first
+
+
+def _get_delay(strategy, hedge_delay):
+    """
+    Seconds to wait for running recognizers before starting the next one,
+    None to wait until they fail
+    """
+
+    return {
+        'sequential': None,
+        'race': 0,
+        'hedged': hedge_delay,
+    }[strategy]
+
+
+@coroutine
+def recognize(recognizers, strategy, hedge_delay, stats, log=None):
+    """
+    Runs recognizers, a list of (name, recognize) where recognize(cancel)
+    returns a Future of the recognized song or None. cancel is a Future
+    resolved once another recognizer succeeded, the recognizer should then
+    abort what it's doing and raise Cancelled.
+
+    Returns (name, song, latencies), name and song of the first recognizer
+    to succeed or None, latencies in ms of the recognizers that finished.
+    """
+
+    log = log or logging.getLogger('logstash-logger')
+    delay = _get_delay(strategy, hedge_delay)
+    latencies = {}
+    queued = list(recognizers)
+    running = {}
+    # recognizers cancelled once another one succeeded, tracked apart from
+    # running since a recognizer can finish before it's added to it
+    cancelled = set()
+
+    @coroutine
+    def timed(name, recognize):
+        t0 = time.time()
+
+        try:
+            res = yield recognize()
+        except Exception:
+            res, error = None, True
+
+            # cancelled recognizers fail by being cancelled
+            if name not in cancelled:
+                log.exception('%s recognition failed', name)
+        else:
+            error = False
+
+        latency = time.time() - t0
+
+        if name not in cancelled:
+            latencies[name] = 1000.0 * latency
+            stats.record(name, latency, hit=bool(res), error=error)
+
+        raise Return(res)
+
+    def start_next():
+        name, recognize = queued.pop(0)
+        cancel = Future()
+        running[timed(name, partial(recognize, cancel))] = name, cancel
+
+    while queued or running:
+        if queued and (not running or delay == 0):
+            start_next()
+            continue
+
+        done = yield _first_done(running.keys(), delay if queued else None)
+
+        if done is None:
+            start_next()
+            continue
+
+        name, _ = running.pop(done)
+        res = done.result()
+
+        if res:
+            for loser, cancel in running.values():
+                stats.record_cancelled(loser)
+                cancelled.add(loser)
+                cancel.set_result(None)
+
+            running.clear()
+            raise Return((name, res, latencies))
+
+    raise Return((None, None, latencies))
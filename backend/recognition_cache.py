@@ -0,0 +1,299 @@
+"""
+Recognition results cache keyed by local audio fingerprint
+"""
+
+from collections import defaultdict
+import hashlib
+import json
+import os
+import time
+
+from tornado.gen import coroutine
+
+import numpy as np
+
+import audio_fingerprint
+from lru import LRUTTLDict
+from persistence import io_executor, write_file_atomically, read_json, unlink_if_exists
+
+# a recording matches a cached one overlapping it by MIN_OVERLAP seconds
+# if they share MIN_MATCHES landmarks at their best alignment and
+# MIN_CONTRAST times as many as at any other alignment. Tuned on synthetic
+# tracks re-recorded with crowd noise down to 0 dB SNR, echo, gain changes
+# and time shifts: every melodic and three quarters of the beat only
+# re-recordings matched, none of 2.5k pairs of other tracks did, beat only
+# tracks at the same tempo included, they shared at most 21 landmarks and
+# barely more than at other alignments.
+MIN_OVERLAP = 7.5
+MIN_MATCHES = 24
+MIN_CONTRAST = 1.4
+
+_MIN_OVERLAP_FRAMES = int(MIN_OVERLAP / audio_fingerprint.FRAME_SECONDS)
+
+# one landmark hash of cached recordings in _INDEX_EVERY is indexed, picked
+# by hash. A lookup matches the _CANDIDATES recordings sharing the most of
+# those with it, by hash only, periodic landmarks of a beat share their
+# hash at many alignments but rarely at the right one.
+_INDEX_EVERY = 8
+_MIN_VOTES = 2
+_CANDIDATES = 20
+
+
+def _indexed(fingerprint):
+    """
+    Returns the distinct indexed landmark hashes of fingerprint
+    """
+
+    hashes = np.unique(fingerprint.hashes)
+    picked = ((hashes.astype(np.uint64) * 2246822519 & 0xffffffff) >> 20) % _INDEX_EVERY == 0
+
+    return hashes[picked].tolist()
+
+
+def _get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return 0
+
+
+def _postings(indexed):
+    if indexed is None:
+        return ()
+
+    return indexed if isinstance(indexed, list) else (indexed,)
+
+
+class RecognitionCache(object):
+    """
+    LRU + TTL in memory cache of (recognizer, recognized song) by local
+    fingerprint, backed by json files in path if it's given. A file is
+    removed once its entry is evicted or expires, path holds at most
+    max_size files.
+
+    Cached fingerprints are indexed by some of their landmarks. A lookup
+    votes for the cached recordings sharing those with it and matches the
+    best ones on all their landmarks, so recordings of the same part of a
+    track at another venue or time hit, not only identical audio.
+
+    Matching is only proven on synthetic recordings, a hit tells which
+    recognizer to ask first and confirm() counts whether it agreed.
+    """
+
+    def __init__(self, max_size, ttl, path=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+
+        self._entries = LRUTTLDict(max_size, ttl, on_remove=self._remove)
+        self._landmarks = {}
+        self._next_id = 0
+        self._files = set()
+        self._listed_mtime = None
+        self._stats = {'hits': 0, 'misses': 0}
+        self._confirmations = {'confirmed': 0, 'contradicted': 0}
+
+    def stats(self):
+        lookups = sum(self._stats.values())
+
+        return dict(
+            self._stats,
+            size=len(self._entries),
+            landmarks=len(self._landmarks),
+            hit_rate=self._stats['hits'] / float(lookups) if lookups else None,
+            confirmed=self._confirmations['confirmed'],
+            contradicted=self._confirmations['contradicted'],
+        )
+
+    def get(self, fingerprint):
+        """
+        Returns (recognizer, recognized song) of a cached recording of the
+        same audio as fingerprint, a local fingerprint, or None
+        """
+
+        votes = defaultdict(int)
+
+        for h in _indexed(fingerprint):
+            for entry_id in _postings(self._landmarks.get(h)):
+                votes[entry_id] += 1
+
+        candidates = sorted(
+            ((n, entry_id) for entry_id, n in votes.items() if n >= _MIN_VOTES),
+            reverse=True,
+        )
+
+        best = None
+
+        for _, entry_id in candidates[:_CANDIDATES]:
+            cached = self._entries.get(entry_id)
+
+            if cached is None:
+                continue
+
+            offset, matches, runner_up = audio_fingerprint.match(fingerprint, cached[0])
+
+            if (
+                matches >= MIN_MATCHES and
+                matches >= MIN_CONTRAST * runner_up and
+                audio_fingerprint.overlap(fingerprint, cached[0], offset) >= _MIN_OVERLAP_FRAMES and
+                (best is None or matches > best[0])
+            ):
+                best = matches, cached[1]
+
+        if best is None:
+            self._stats['misses'] += 1
+            return
+
+        self._stats['hits'] += 1
+        return best[1]
+
+    def confirm(self, confirmed):
+        """
+        Counts whether the recognizer of a hit recognized the same song
+        """
+
+        self._confirmations['confirmed' if confirmed else 'contradicted'] += 1
+
+    def put(self, fingerprint, recognizer, recognized_song):
+        # too short to ever overlap another recording enough
+        if fingerprint.frames < _MIN_OVERLAP_FRAMES:
+            return
+
+        entry = recognizer, recognized_song
+        key = None
+
+        if self.path is not None:
+            key = hashlib.sha1(fingerprint.hashes.tostring() + fingerprint.times.tostring()).hexdigest()
+            self._files.add(key)
+
+        self._add(fingerprint, entry, key)
+
+        if key is not None:
+
+            io_executor.submit(
+                write_file_atomically,
+                self._get_path(key),
+                json.dumps({
+                    'expires': time.time() + self.ttl,
+                    'entry': entry,
+                    'landmarks': fingerprint.dump(),
+                }),
+            )
+
+    @coroutine
+    def sync(self):
+        """
+        Loads the recognitions persisted in path by this or other processes
+        that aren't loaded yet, path is only listed if it changed since
+        """
+
+        if self.path is None:
+            return
+
+        # drops the expired entries, removing their files
+        len(self._entries)
+
+        self._listed_mtime, loaded = yield io_executor.submit(
+            self._read_new,
+            frozenset(self._files),
+            self._listed_mtime,
+        )
+
+        for key, expires, fingerprint, entry in loaded:
+            if key not in self._files:
+                self._files.add(key)
+                self._add(fingerprint, entry, key, expires)
+
+    def _add(self, fingerprint, entry, key=None, expires=None):
+        entry_id = self._next_id
+        self._next_id += 1
+
+        for h in _indexed(fingerprint):
+            indexed = self._landmarks.get(h)
+
+            if indexed is None:
+                self._landmarks[h] = entry_id
+            elif isinstance(indexed, list):
+                indexed.append(entry_id)
+            else:
+                self._landmarks[h] = [indexed, entry_id]
+
+        self._entries[entry_id] = fingerprint, entry, key
+
+        if expires is not None:
+            self._entries.expire_at(entry_id, expires)
+
+    def _remove(self, entry_id, cached):
+        fingerprint, _, key = cached
+
+        for h in _indexed(fingerprint):
+            indexed = self._landmarks[h]
+
+            if not isinstance(indexed, list):
+                del self._landmarks[h]
+                continue
+
+            indexed.remove(entry_id)
+
+            if len(indexed) == 1:
+                self._landmarks[h] = indexed[0]
+
+        if key is not None:
+            self._files.discard(key)
+            io_executor.submit(unlink_if_exists, self._get_path(key))
+
+    def _read_new(self, known, listed_mtime):
+        """
+        Returns the mtime of path and (key, expires, fingerprint, entry) of
+        its files not in known, oldest first, if path changed since it was
+        listed_mtime. Removes the expired files and the oldest ones beyond
+        max_size.
+        """
+
+        # taken before listing so files added meanwhile are listed next time
+        mtime = os.stat(self.path).st_mtime
+
+        if mtime == listed_mtime:
+            return mtime, []
+
+        names = [name for name in os.listdir(self.path) if name.endswith('.json')]
+
+        if len(names) > self.max_size:
+            names.sort(key=lambda name: _get_mtime(os.path.join(self.path, name)), reverse=True)
+
+            for name in names[self.max_size:]:
+                unlink_if_exists(os.path.join(self.path, name))
+
+            names = names[:self.max_size]
+
+        loaded = []
+
+        for name in names:
+            key = os.path.splitext(name)[0]
+
+            if key in known:
+                continue
+
+            path = self._get_path(key)
+
+            try:
+                cached = read_json(path)
+            except (IOError, ValueError):
+                continue
+
+            # expired, or cached by an earlier fingerprint
+            if 'landmarks' not in cached or cached.get('expires', 0) < time.time():
+                unlink_if_exists(path)
+                continue
+
+            loaded.append((
+                key,
+                cached['expires'],
+                audio_fingerprint.Fingerprint.load(cached['landmarks']),
+                tuple(cached['entry']),
+            ))
+
+        return mtime, sorted(loaded, key=lambda l: l[1])
+
+    def _get_path(self, key):
+        return os.path.join(self.path, '{}.json'.format(key))
@@ -0,0 +1,201 @@
+"""
+Queue of uploaded samples waiting for recognition
+"""
+
+from collections import defaultdict
+import logging
+import os
+import time
+import uuid
+
+from tornado.gen import coroutine
+from tornado.locks import Lock
+from tornado.queues import Queue, QueueFull
+from persistence import io_executor, commit_file, unlink_if_exists, try_flock
+from sample_processor import SampleProcessor
+from metrics import timed
+
+_PENDING_DIR = '.pending'
+_OWNER_LOCK = '.lock'
+
+
+class RecognitionQueue(object):
+    """
+    Samples wait in samples_root/.pending until a worker processed them, so
+    the ones left when the server stops are replayed on start. Submitting
+    fails with QueueFull once max_depth samples are waiting.
+
+    Samples of a box are processed one at a time, also across server
+    processes, since the decision depends on the latest sample.
+
+    Each server process started with --workers has its own slot in
+    .pending, others use .pending itself. A process holds the lock of its
+    directory while it runs and on start claims, by renaming them, the
+    samples left in every other directory whose lock is free, so samples
+    are replayed whatever the number of workers of the next start.
+    """
+
+    def __init__(self, settings, max_depth, workers, slot=None):
+        self.settings = settings
+        self.max_depth = max_depth
+        self.workers = workers
+
+        self.pending_dir = os.path.join(settings['samples_root'], _PENDING_DIR)
+
+        if slot is not None:
+            self.pending_dir = os.path.join(self.pending_dir, str(slot))
+
+        self._owner_lock = None
+        self._queue = Queue()
+        self._reserved = 0
+        self._busy = 0
+        self._box_locks = defaultdict(Lock)
+        self._stats = {
+            'enqueued': 0,
+            'replayed': 0,
+            'rejected': 0,
+            'processed': 0,
+            'failed': 0,
+        }
+
+    def start(self):
+        """
+        Replays pending samples and starts the workers
+        """
+
+        if not os.path.isdir(self.pending_dir):
+            os.makedirs(self.pending_dir)
+
+        # another process starting might be claiming our samples for a moment
+        for _ in xrange(50):
+            self._owner_lock = try_flock(os.path.join(self.pending_dir, _OWNER_LOCK))
+
+            if self._owner_lock is not None:
+                break
+
+            time.sleep(0.1)
+        else:
+            raise RuntimeError('{} is used by another process'.format(self.pending_dir))
+
+        shared_dir = os.path.join(self.settings['samples_root'], _PENDING_DIR)
+        slot_dirs = [os.path.join(shared_dir, name) for name in os.listdir(shared_dir)]
+
+        for path in [shared_dir] + slot_dirs:
+            if path != self.pending_dir and os.path.isdir(path):
+                self._claim(path)
+
+        for filename in sorted(os.listdir(self.pending_dir)):
+            if not filename.endswith('.mp3'):
+                continue
+
+            # pending before names were unique have no suffix
+            box_id, name, _ = filename.rsplit('.', 2)
+            sample_id = int(name.split('-')[0])
+            self._queue.put_nowait((box_id, sample_id, os.path.join(self.pending_dir, filename), time.time()))
+            self._stats['replayed'] += 1
+
+        if self._stats['replayed']:
+            logging.getLogger('logstash-logger').info('replaying %d pending samples', self._stats['replayed'])
+
+        for _ in xrange(self.workers):
+            self._work()
+
+    def _claim(self, path):
+        """
+        Moves the samples pending in path to our directory unless the
+        process owning path is running
+        """
+
+        fd = try_flock(os.path.join(path, _OWNER_LOCK))
+
+        if fd is None:
+            return
+
+        try:
+            for filename in os.listdir(path):
+                if not filename.endswith('.mp3'):
+                    continue
+
+                try:
+                    os.rename(os.path.join(path, filename), os.path.join(self.pending_dir, filename))
+                except OSError:
+                    # claimed by another process
+                    pass
+        finally:
+            os.close(fd)
+
+    def depth(self):
+        return self._queue.qsize() + self._reserved
+
+    @coroutine
+    def submit(self, box_id, sample_id, tmp_path):
+        """
+        Moves the sample at tmp_path to the pending samples and enqueues it
+        """
+
+        if self.depth() >= self.max_depth:
+            self._stats['rejected'] += 1
+            raise QueueFull()
+
+        # a box may upload twice within a second, to any process
+        pending_path = os.path.join(
+            self.pending_dir,
+            '{}.{}-{}.mp3'.format(box_id, sample_id, uuid.uuid4().hex),
+        )
+
+        # counted in the depth while being renamed so concurrent uploads can't overflow
+        self._reserved += 1
+
+        try:
+            yield io_executor.submit(commit_file, tmp_path, pending_path)
+        finally:
+            self._reserved -= 1
+
+        self._queue.put_nowait((box_id, sample_id, pending_path, time.time()))
+        self._stats['enqueued'] += 1
+
+    @coroutine
+    def _work(self):
+        while True:
+            box_id, sample_id, pending_path, enqueued_at = yield self._queue.get()
+            self._busy += 1
+
+            try:
+                yield self._process(box_id, sample_id, pending_path, enqueued_at)
+            finally:
+                self._busy -= 1
+
+    @coroutine
+    def _process(self, box_id, sample_id, pending_path, enqueued_at):
+        processor = SampleProcessor(self.settings, box_id, sample_id)
+        processor.timings['queue_wait'] = 1000.0 * (time.time() - enqueued_at)
+
+        try:
+            with (yield self._box_locks[box_id].acquire()), timed(processor.timings, 'processing'):
+                # reloads the box if another process added the latest sample
+                yield self.settings['samples'].lock(box_id)
+
+                try:
+                    yield processor.process(pending_path)
+                finally:
+                    self.settings['samples'].unlock(box_id)
+        except Exception:
+            self._stats['failed'] += 1
+            processor.log().exception('could not process sample')
+        else:
+            self._stats['processed'] += 1
+        finally:
+            # kept samples were renamed away, a failing sample isn't retried
+            yield io_executor.submit(unlink_if_exists, pending_path)
+
+        self.settings['latency'].observe(box_id, processor.timings)
+        processor.log().info('sample processed')
+
+    def stats(self):
+        return dict(
+            self._stats,
+            depth=self.depth(),
+            max_depth=self.max_depth,
+            busy=self._busy,
+            workers=self.workers,
+        )
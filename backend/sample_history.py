@@ -0,0 +1,111 @@
+"""
+Fixed capacity sample history of a box
+"""
+
+
+class SampleHistory(object):
+    """
+    Ring buffer of the latest capacity samples, adding a sample overwrites
+    the oldest one in place. Samples are indexed by creation time.
+    """
+
+    def __init__(self, capacity, samples=()):
+        """
+        samples are sample records, newest first
+        """
+
+        self.capacity = capacity
+
+        self._buffer = [None] * capacity
+        self._head = 0
+        self._size = 0
+        self._index = {}
+
+        for sample in reversed(samples[:capacity]):
+            self.push(sample)
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        return self.newest()
+
+    def _slot(self, age):
+        return (self._head - 1 - age) % self.capacity
+
+    def push(self, sample):
+        """
+        Adds sample as the latest one, evicting the oldest when full
+        """
+
+        evicted = self._buffer[self._head]
+
+        if evicted is not None and self._index.get(evicted.created) == self._head:
+            del self._index[evicted.created]
+
+        self._buffer[self._head] = sample
+        self._index[sample.created] = self._head
+        self._head = (self._head + 1) % self.capacity
+        self._size = min(self._size + 1, self.capacity)
+
+    def push_oldest(self, sample):
+        """
+        Adds sample as the oldest one, the history mustn't be full
+        """
+
+        slot = self._slot(self._size)
+        self._buffer[slot] = sample
+        self._index[sample.created] = slot
+        self._size += 1
+
+    def replace_latest(self, sample):
+        """
+        Replaces the latest sample with sample, returns the replaced one
+        """
+
+        slot = self._slot(0)
+        replaced = self._buffer[slot]
+
+        del self._index[replaced.created]
+        self._buffer[slot] = sample
+        self._index[sample.created] = slot
+
+        return replaced
+
+    def latest(self):
+        if self._size:
+            return self._buffer[self._slot(0)]
+
+    def get(self, created):
+        """
+        Returns the sample created at created, None if it's not in the history
+        """
+
+        slot = self._index.get(created)
+
+        if slot is not None:
+            return self._buffer[slot]
+
+    def newest(self, n=None, before=None):
+        """
+        Yields at most n samples, newest first, only those created before
+        before if it's given
+        """
+
+        n = self._size if n is None else n
+        age = 0
+
+        if before is not None:
+            # samples get older with age, binary search the first one before
+            high = self._size
+
+            while age < high:
+                middle = (age + high) // 2
+
+                if self._buffer[self._slot(middle)].created >= before:
+                    age = middle + 1
+                else:
+                    high = middle
+
+        for age in xrange(age, min(age + n, self._size)):
+            yield self._buffer[self._slot(age)]
@@ -0,0 +1,311 @@
+"""
+Recognition and keep / ignore decision for uploaded samples
+"""
+
+import time
+import os
+import logging
+from functools import partial
+
+from tornado.gen import coroutine, Return
+import audio_fingerprint
+from persistence import io_executor, commit_file
+from recognition import recognize
+from acrcloud_client import fingerprint, FINGERPRINT_RATE
+from decoder import decode, resample, RATE
+from utils import normalize_acrcloud_response, is_same_song, normalize_metadata
+from metrics import timed
+from concurrent.futures import ThreadPoolExecutor
+
+
+def is_recognized(sample):
+    """
+    Determines if sample is recognized by music fingerprinting
+    """
+
+    if sample is None:
+        return False
+
+    return sample['metadata'] is not None and 'recognized_song' in sample['metadata']
+
+
+def decode_sample(sample_path):
+    """
+    Decodes sample once, returns its PCM, ACRCloud fingerprint and local
+    fingerprint
+    """
+
+    pcm = decode(sample_path)
+
+    return (
+        pcm,
+        fingerprint(resample(pcm, FINGERPRINT_RATE)),
+        audio_fingerprint.fingerprint(resample(pcm, audio_fingerprint.RATE)),
+    )
+
+
+def is_same_recognition(a, b):
+    """
+    Checks if two (recognizer, recognized song) name the same song
+    """
+
+    if a[1] is None or b[1] is None:
+        return False
+
+    a, b = (normalize_metadata({name: song})['recognized_song'] for name, song in (a, b))
+    return is_same_song(a, b)
+
+
+def is_fresh(sample, sample_interval):
+    """
+    Checks if sample is fresh by comparing seconds since its creation to the sample interval
+    """
+
+    if sample is None:
+        return False
+
+    return (int(time.time()) - sample['_created']) < sample_interval
+
+
+class SampleProcessor(object):
+    """
+    Decides whether to keep a single sample of a box, settings are the
+    application settings
+    """
+
+    _thread_pool = ThreadPoolExecutor(4)
+
+    def __init__(self, settings, boxid, sample_id):
+        self.settings = settings
+        self.boxid = boxid
+        self.sample_id = sample_id
+
+        # ms per stage, recognizers included
+        self.timings = {}
+
+        self.extra_log_args = {
+            'boxid': boxid,
+            'sample_path': self.get_sample_path(),
+            'timings': self.timings,
+        }
+
+    def get_sample_path(self):
+        return os.path.join(self.settings['samples_root'], self.boxid, '{}.mp3'.format(self.sample_id))
+
+    def log(self):
+        return logging.LoggerAdapter(logging.getLogger('logstash-logger'), self.extra_log_args)
+
+    @coroutine
+    def _recognize_sample_with_acrcloud(self, fingerprint, cancel):
+        res = yield self.settings['acrcloud'].identify(fingerprint, cancel)
+
+        if 'metadata' not in res:
+            self.log().error('acrcloud could not recognize sample')
+            return
+
+        raise Return(res['metadata']['music'][0])
+
+    @coroutine
+    def recognize_sample_with_acrcloud(self, fingerprint, cancel=None):
+        if fingerprint is None:
+            self.log().error('acrcloud could not fingerprint sample')
+            return
+
+        self.log().info('trying to recognize with acrcloud')
+        recognized_song = yield self._recognize_sample_with_acrcloud(fingerprint, cancel)
+
+        if recognized_song:
+            self.extra_log_args['acrcloud'] = normalize_acrcloud_response(recognized_song)
+            raise Return(recognized_song)
+
+    @coroutine
+    def recognize_sample_with_gracenote(self, pcm, cancel=None):
+        if pcm is None:
+            return
+
+        recognized_song = yield self.settings['gracenote'].identify(pcm, RATE, cancel=cancel)
+
+        if 'error' in recognized_song:
+            self.log().error('gracenote: %s', recognized_song['error'])
+            return
+
+        self.extra_log_args['gracenote'] = recognized_song
+        raise Return(recognized_song)
+
+    @coroutine
+    def recognize_sample(self, pcm, fingerprint, hint=None):
+        """
+        Runs the recognizers, hint first and on its own if it's given
+        """
+
+        recognizers = [
+            ('gracenote', partial(self.recognize_sample_with_gracenote, pcm)),
+            ('acrcloud', partial(self.recognize_sample_with_acrcloud, fingerprint)),
+        ]
+        strategy = self.settings['recognition_strategy']
+
+        if hint is not None:
+            recognizers.sort(key=lambda recognizer: recognizer[0] != hint)
+            strategy = 'sequential'
+
+        name, recognized_song, latencies = yield recognize(
+            recognizers,
+            strategy,
+            self.settings['hedge_delay'],
+            self.settings['recognition_stats'],
+            self.log(),
+        )
+
+        self.extra_log_args['recognition_latency'] = latencies
+        self.timings.update(latencies)
+        raise Return((name, recognized_song))
+
+    @coroutine
+    def get_metadata(self, boxid, sample_path):
+        metadata = {
+            'hidden': False,
+            'keep_unrecognized': self.settings['clubs'].is_recognition_on_hold(boxid),
+        }
+
+        cache = self.settings['recognition_cache']
+        cached = None
+
+        try:
+            with timed(self.timings, 'decode'):
+                pcm, fingerprint, frames = yield self._thread_pool.submit(decode_sample, sample_path)
+        except Exception:
+            self.log().exception('could not decode sample')
+            pcm = fingerprint = frames = None
+
+        if frames is not None:
+            with timed(self.timings, 'cache'):
+                cached = cache.get(frames)
+
+        if cached is not None and self.settings['recognition_cache_trusted']:
+            self.log().info('recognition cache hit')
+            name, recognized_song = cached
+        else:
+            # a hit is only a hint, the recognizer it names confirms it
+            if cached is not None:
+                self.log().info('recognition cache hit, confirming with %s', cached[0])
+
+            with timed(self.timings, 'recognition'):
+                name, recognized_song = yield self.recognize_sample(pcm, fingerprint, cached and cached[0])
+
+            confirmed = cached is not None and is_same_recognition(cached, (name, recognized_song))
+
+            if cached is not None:
+                cache.confirm(confirmed)
+
+            if frames is not None and recognized_song is not None and not confirmed:
+                cache.put(frames, name, recognized_song)
+
+        self.extra_log_args['recognition_cache_hit'] = cached is not None
+
+        if recognized_song is not None:
+            metadata[name] = recognized_song
+
+        raise Return(metadata)
+
+    def is_fresh(self, sample):
+        """
+        Checks if sample is fresh by comparing seconds since its creation to the sample
+        interval specified in settings
+        """
+
+        return is_fresh(sample, self.settings['sample_interval'])
+
+    def is_latest_sample_fresh_and_recognized(self, latest_sample):
+        """
+        Checks if latest sample fresh and recognized.
+        """
+
+        if self.is_fresh(latest_sample) and is_recognized(latest_sample):
+            self.log().info('latest sample is fresh and recognized')
+            return True
+
+    def is_same_song(self, latest_sample, metadata):
+        """
+        Checks if current sample is a duplicate of latest sample
+        """
+
+        if is_recognized(latest_sample) and 'recognized_song' in metadata:
+            latest_song = latest_sample['metadata']['recognized_song']
+            current_song = metadata['recognized_song']
+
+            if is_same_song(latest_song, current_song):
+                self.log().info('ignoring current sample as it is recognized as the latest sample')
+                return True
+
+    def should_replace_latest_with_current(self, latest_sample, metadata):
+        """
+        Should replace latest with current if latest sample is stale
+        or if it's fresh and unrecognized, amd current sample is recognized
+        """
+
+        if not self.is_fresh(latest_sample):
+            return
+
+        if not is_recognized(latest_sample) and 'recognized_song' in metadata:
+            return True
+
+    def is_latest_sample_fresh_and_current_unrecognized(self, latest_sample, metadata):
+        """
+        Checks if latest sample still fresh for replacing, and that current sample is recognized
+        """
+
+        if self.is_fresh(latest_sample) and 'recognized_song' not in metadata:
+            self.log().info('latest sample still fresh and current sample unrecognized, ignoring')
+            return True
+
+    @coroutine
+    def process(self, tmp_path):
+        """
+        Renames the sample at tmp_path into the samples of the box if it's kept.
+
+        FRESH sample: a sample younger than sampling interval (i.e if we want to sample every
+        4 minutes, then a sample taken < 4 minutes ago considered fresh, otherwise it's STALE)
+
+        1. If latest sample is FRESH and it's recognized, ignore current sample.
+        2. If latest sample recognized and current sample recognized,
+           and they are the same song, ignore current sample.
+        3. if lastest sample is STALE, use current sample.
+        4. If latest sample is FRESH but not recognized:
+          4.1. If current sample recognized, it replaces the last sample
+          4.2. if current sample isn't recognized, ignore current sample
+        """
+
+        boxid = self.boxid
+        sample_id = self.sample_id
+        sample_path = self.get_sample_path()
+        samples_dir = os.path.dirname(sample_path)
+        latest_sample = self.settings['samples'].latest(boxid)
+
+        if not os.path.isdir(samples_dir):
+            os.mkdir(samples_dir)
+
+        if self.is_latest_sample_fresh_and_recognized(latest_sample):
+            return
+
+        full_metadata = yield self.get_metadata(boxid, tmp_path)
+        metadata = normalize_metadata(full_metadata)
+
+        if self.is_same_song(latest_sample, metadata):
+            return
+
+        if self.is_latest_sample_fresh_and_current_unrecognized(latest_sample, metadata):
+            return
+
+        # We always create a new sample, even when replacing an old
+        # sample because clients will access it until they refresh and get
+        # the new one.
+        with timed(self.timings, 'commit'):
+            yield io_executor.submit(commit_file, tmp_path, sample_path)
+
+        with timed(self.timings, 'metadata_write'):
+            if self.should_replace_latest_with_current(latest_sample, metadata):
+                self.log().info('latest sample still fresh but unrecognized, replacing with recognized')
+                yield self.settings['samples'].replace_latest(sample_id, full_metadata, boxid)
+            else:
+                self.log().info('adding new sample')
+                yield self.settings['samples'].add(sample_id, full_metadata, boxid)
@@ -0,0 +1,87 @@
+"""
+Compact in-memory sample records
+
+Only what the API serves is kept, raw recognizer payloads stay in the
+sample metadata file. The date and link are derived when serializing.
+"""
+
+import os
+
+from utils import unix_time_to_readable_date
+
+# recognizer and genre names repeat across every sample
+_interned = {}
+
+
+def _intern(s):
+    return _interned.setdefault(s, s)
+
+
+class Song(object):
+    __slots__ = ('album', 'title', 'artists', 'genres', 'recognizer')
+
+    def __init__(self, song):
+        self.album = song['album']
+        self.title = song['title']
+        self.artists = tuple(song['artists'])
+        self.genres = tuple(_intern(g) for g in song['genres'])
+        self.recognizer = _intern(song['_recognizer'])
+
+    def serialize(self):
+        return {
+            'album': self.album,
+            'title': self.title,
+            'artists': list(self.artists),
+            'genres': list(self.genres),
+            '_recognizer': self.recognizer,
+        }
+
+
+class Sample(object):
+    __slots__ = ('created', 'hidden', 'keep_unrecognized', 'song')
+
+    def __init__(self, created, metadata):
+        """
+        metadata is the normalized metadata of the sample
+        """
+
+        self.created = created
+        self.hidden = metadata.get('hidden', False)
+        self.keep_unrecognized = metadata.get('keep_unrecognized', False)
+
+        song = metadata.get('recognized_song')
+        self.song = Song(song) if song is not None else None
+
+    @classmethod
+    def load(cls, dumped):
+        """
+        Returns the sample dumped by dump()
+        """
+
+        return cls(dumped[0], dumped[1])
+
+    def dump(self):
+        """
+        Returns a json-able record of the sample, for indexes
+        """
+
+        return [self.created, self._metadata()]
+
+    def _metadata(self):
+        metadata = {
+            'hidden': self.hidden,
+            'keep_unrecognized': self.keep_unrecognized,
+        }
+
+        if self.song is not None:
+            metadata['recognized_song'] = self.song.serialize()
+
+        return metadata
+
+    def serialize(self, box_id, base_url):
+        return {
+            '_created': self.created,
+            'date': unix_time_to_readable_date(self.created),
+            'link': os.path.join(base_url, 'uploads', box_id, '{}.mp3'.format(self.created)),
+            'metadata': self._metadata(),
+        }
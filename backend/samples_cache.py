@@ -2,102 +2,453 @@
 Samples cache
 """
 
-from collections import defaultdict
 import json
 import os
 
-from utils import unix_time_to_readable_date, number_part_of_sample, get_metadata_from_json
+from tornado.gen import coroutine, sleep, Return
+from tornado.locks import Lock
 
+from persistence import io_executor, write_file, write_file_atomically, read_json, try_flock
+from utils import number_part_of_sample, get_metadata_from_json, normalize_metadata
+from sample_record import Sample
+from sample_history import SampleHistory
+
+_INDEX_FILE = '.index'
+_LOCKS_DIR = '.locks'
+
+
+def _get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    return st.st_mtime, st.st_size
+
+
+def _write_index_file(path, data):
+    write_file(path, data)
+    return _stat(path)
+
+
+def _entry_id(entry):
+    return entry if isinstance(entry, int) else entry[0]
 
 
 class SamplesCache(object):
     """
-    Samples cache
+    Samples cache, boxes are read from their index file, falling back to
+    scanning the box directory if the index is missing or stale.
+
+    Samples are held as compact records and serialized to dicts on access.
+    Each box keeps a history of history_size samples, of which the latest
+    n_samples are returned by get().
+
+    The index holds the records too, so loading a box reads no sample
+    metadata. Indexes written before, or rebuilt from the directory, only
+    have the ids of some samples: the latest n_samples of those are read
+    when the box is loaded, older ones when the history reaches them.
+
+    Boxes are read on io_executor and served once read: sync() loads new
+    boxes and reloads those changed by other processes, serving them as
+    they were meanwhile. get() and latest() never touch the disk, a box
+    sync() hasn't loaded yet has no samples.
+
+    Server processes share the samples root. Changes to a box are made
+    holding its lock, after reloading the box if another process changed
+    it, so no process writes the index from an outdated history.
     """
 
-    def __init__(self, samples_root, n_samples, base_url):
+    def __init__(self, samples_root, n_samples, base_url, history_size=None):
         self.samples_root = samples_root
         self.n_samples = n_samples
+        self.history_size = max(history_size or n_samples, n_samples)
         self.base_url = base_url
+        self.version = 0
+
+        self._samples = {}
+        self._unloaded = {}
+        self._index_stats = {}
+        self._locks = {}
+        self._root_mtime = None
+        self._history_lock = Lock()
 
-        self._samples = defaultdict(list)
-        self._populate_samples_cache()
+        # reads are numbered, a box is only replaced by a read started
+        # after the one it was read by and after its last change
+        self._reads = 0
+        self._read_after = {}
 
-    def all(self):
+    @coroutine
+    def sync(self):
         """
-        Returns dict of clubs -> samples
+        Loads the boxes that aren't loaded yet and reloads those whose index
+        another process changed since, the samples root is only listed if it
+        changed
         """
 
-        return self._samples
+        self._root_mtime, box_ids = yield io_executor.submit(
+            self._find_changed,
+            dict(self._index_stats),
+            self._root_mtime,
+        )
+
+        for box_id in box_ids:
+            # changing it, lock() reloads it first
+            if box_id not in self._locks:
+                yield self._load(box_id)
+
+    def sizes(self):
+        """
+        Returns how many samples are cached per loaded box, without touching the disk
+        """
+
+        return {box_id: len(samples) for box_id, samples in self._samples.items()}
+
+    def get(self, box_id):
+        """
+        Returns samples of box, None if box has no samples
+        """
+
+        samples = self._samples.get(box_id)
+
+        if samples is not None:
+            return self._serialize(box_id, samples.newest(self.n_samples)) or None
+
+    @coroutine
+    def history(self, box_id, limit, before=None):
+        """
+        Returns at most limit samples of box, newest first, only those
+        created before before if it's given
+        """
+
+        if box_id not in self._samples:
+            yield self._load(box_id)
+
+        # one at a time so older samples are pushed in order
+        with (yield self._history_lock.acquire()):
+            samples = self._samples.get(box_id)
+
+            if samples is None:
+                raise Return([])
+
+            unloaded = self._unloaded[box_id]
+
+            while unloaded and sum(1 for _ in samples.newest(limit, before)) < limit:
+                record = yield io_executor.submit(self._load_entry, box_id, unloaded.pop(0))
+                samples.push_oldest(record)
+
+            raise Return(self._serialize(box_id, samples.newest(limit, before)))
 
     def latest(self, box_id):
         """
         Returns latest sample for box
         """
 
-        try:
-            return self._samples[box_id][0]
-        except (KeyError, IndexError):
-            return None
+        samples = self._samples.get(box_id)
+        latest = samples.latest() if samples is not None else None
+
+        if latest is not None:
+            return latest.serialize(box_id, self.base_url)
+
+    @coroutine
+    def lock(self, box_id):
+        """
+        Takes the box lock shared with other processes and reloads the box
+        if it isn't loaded or another process changed it. Coroutines of
+        this process share the lock, each lock() must be followed by an
+        unlock().
+        """
+
+        while box_id not in self._locks:
+            fd = self._try_lock(box_id)
+
+            if fd is not None:
+                try:
+                    changed = yield io_executor.submit(self._is_changed, box_id, self._index_stats.get(box_id))
+
+                    if changed or box_id not in self._samples:
+                        yield self._load(box_id, locked=True)
+                except Exception:
+                    os.close(fd)
+                    raise
+
+                self._locks[box_id] = [fd, 0]
+                break
 
+            yield sleep(0.1)
+
+        self._locks[box_id][1] += 1
+
+    def unlock(self, box_id):
+        held = self._locks[box_id]
+        held[1] -= 1
+
+        if not held[1]:
+            del self._locks[box_id]
+            os.close(held[0])
+
+    @coroutine
     def add(self, sample, metadata, box_id):
         """
-        Insert sample into box samples while keeping samples size n_samples
+        Adds sample to box history, evicting the oldest sample once it has
+        history_size samples
         """
 
-        self._write_metadata(sample, metadata, box_id)
+        yield self.lock(box_id)
+
+        try:
+            yield self._write_metadata(sample, metadata, box_id)
+            samples = self._box_samples(box_id)
+            unloaded = self._unloaded[box_id]
+
+            # the oldest sample might not be loaded
+            if unloaded and len(samples) + len(unloaded) >= self.history_size:
+                unloaded.pop()
 
-        if len(self._samples[box_id]) == self.n_samples:
-            self._samples[box_id].pop()
+            samples.push(Sample(sample, normalize_metadata(metadata)))
+            self._changed(box_id)
 
-        self._samples[box_id].insert(0, self._enrich_sample(sample, box_id))
+            yield self._write_index(box_id)
+        finally:
+            self.unlock(box_id)
 
+    @coroutine
     def toggle_hiddeness(self, box_id, sample):
-        metadata = json.loads(open(self._get_json_path(box_id, sample)).read())
-        metadata['hidden'] = not metadata.get('hidden', False)
-        self._write_metadata(sample, metadata, box_id)
+        yield self.lock(box_id)
 
-        for s in self._samples[box_id]:
-            if s['_created'] == sample:
-                s['metadata']['hidden'] = not s['metadata'].get('hidden', False)
-                break
+        try:
+            metadata = yield io_executor.submit(read_json, self._get_json_path(box_id, sample))
+            metadata['hidden'] = not metadata.get('hidden', False)
+            yield self._write_metadata(sample, metadata, box_id)
+
+            record = self._box_samples(box_id).get(sample)
+
+            if record is not None:
+                record.hidden = metadata['hidden']
+
+            unloaded = self._unloaded[box_id]
+
+            for i, entry in enumerate(unloaded):
+                if _entry_id(entry) == sample:
+                    unloaded[i] = Sample(sample, normalize_metadata(metadata)).dump()
+
+            self._changed(box_id)
 
+            yield self._write_index(box_id)
+        finally:
+            self.unlock(box_id)
+
+    @coroutine
     def replace_latest(self, sample, metadata, box_id):
         """
         Replaces last sample with new sample
         """
 
-        self._write_metadata(sample, metadata, box_id)
+        yield self.lock(box_id)
+
+        try:
+            yield self._write_metadata(sample, metadata, box_id)
+            replaced = self._box_samples(box_id).replace_latest(Sample(sample, normalize_metadata(metadata))).created
+            self._changed(box_id)
+
+            yield io_executor.submit(os.unlink, self._get_json_path(box_id, replaced))
+            yield self._write_index(box_id)
+        finally:
+            self.unlock(box_id)
+
+    def _box_samples(self, box_id):
+        # the box is locked, so loaded
+        return self._samples[box_id]
+
+    def _changed(self, box_id):
+        self.version += 1
+        self._read_after[box_id] = self._reads
+
+    @coroutine
+    def _load(self, box_id, locked=False):
+        """
+        Reads box on io_executor and serves it, unless a later read or a
+        change of the box got there first
+        """
+
+        self._reads += 1
+        read = self._reads
+
+        samples, unloaded, index_stat = yield io_executor.submit(self._read_box, box_id, locked)
+
+        if read > self._read_after.get(box_id, 0):
+            self._samples[box_id] = samples
+            self._unloaded[box_id] = unloaded
+            self._index_stats[box_id] = index_stat
+            self._read_after[box_id] = read
+            self.version += 1
+
+    def _find_changed(self, index_stats, root_mtime):
+        """
+        Returns the mtime of the samples root and the boxes not loaded yet
+        or whose index changed since it was index_stats, new boxes are only
+        looked for if the root changed since it was root_mtime
+        """
+
+        # taken before listing so boxes added meanwhile are listed next time
+        mtime = _get_mtime(self.samples_root)
+        box_ids = [box_id for box_id, index_stat in index_stats.items() if self._is_changed(box_id, index_stat)]
+
+        if mtime != root_mtime and mtime is not None:
+            box_ids.extend(
+                box_id for box_id in os.listdir(self.samples_root)
+                if not box_id.startswith('.') and box_id not in index_stats and
+                os.path.isdir(os.path.join(self.samples_root, box_id))
+            )
+
+        return mtime, box_ids
+
+    def _is_changed(self, box_id, index_stat):
+        # a write within the mtime granularity is told by the size
+        return _stat(self._get_index_path(box_id)) != index_stat
+
+    def _read_box(self, box_id, locked):
+        """
+        Returns (history, unloaded entries, index (mtime, size)) of box,
+        runs on io_executor
+        """
+
+        entries, index_stat = self._load_samples(box_id, locked)
+        loaded = []
+
+        while entries and (len(loaded) < self.n_samples or not isinstance(entries[0], int)):
+            loaded.append(self._load_entry(box_id, entries.pop(0)))
+
+        return SampleHistory(self.history_size, loaded), entries, index_stat
+
+    def _load_entry(self, box_id, entry):
+        if isinstance(entry, int):
+            return Sample(entry, self._get_metadata(entry, box_id))
+
+        return Sample.load(entry)
+
+    def _load_samples(self, box_id, locked):
+        """
+        Returns the index entries of box, newest first: sample records, or
+        ids of samples whose record isn't in the index, and the index (mtime,
+        size)
+        """
+
+        if not os.path.isdir(os.path.join(self.samples_root, box_id)):
+            return [], None
+
+        # taken before reading so a concurrent write is picked up by sync()
+        index_stat = _stat(self._get_index_path(box_id))
+        index = self._read_index(box_id)
+
+        if index is not None and not index['stale'] and index['history_size'] >= self.history_size:
+            samples = index['samples'][:self.history_size]
+        else:
+            samples = self._get_samples(box_id, index['samples'] if index else [], index_stat and index_stat[0])
+
+            # rebuilding the index races with the process changing the box
+            # unless we're that process
+            fd = self._try_lock(box_id) if not locked else None
+
+            if fd is not None or locked:
+                try:
+                    index_stat = _write_index_file(self._get_index_path(box_id), self._dump_index(samples))
+                finally:
+                    if fd is not None:
+                        os.close(fd)
+
+        return samples, index_stat
+
+    def _read_index(self, box_id):
+        """
+        Returns the box index, stale if it's older than the last change to
+        the box directory, None if it's missing
+        """
+
+        path = self._get_index_path(box_id)
+
+        try:
+            stale = os.stat(path).st_mtime < os.stat(os.path.dirname(path)).st_mtime
+            index = json.loads(open(path).read())
+        except (OSError, IOError, ValueError):
+            return None
+
+        # indexes written before history_size are a bare list of ids
+        if not isinstance(index, dict):
+            index = {'history_size': len(index), 'samples': index}
 
-        os.unlink(self._get_json_path(box_id, self._samples[box_id][0]['_created']))
-        self._samples[box_id][0] = self._enrich_sample(sample, box_id)
+        index['stale'] = stale
+        return index
 
-    def _populate_samples_cache(self):
-        for box_id in os.listdir(self.samples_root):
-            self._samples[box_id] = self._enrich_samples(self._get_samples(box_id), box_id)
+    def _dump_index(self, samples):
+        return json.dumps({'history_size': self.history_size, 'samples': samples})
+
+    @coroutine
+    def _write_index(self, box_id):
+        """
+        The index is written in place rather than renamed, a rename would
+        make the box directory newer than the index and mark it stale
+        """
+
+        samples = [s.dump() for s in self._samples[box_id]] + self._unloaded[box_id]
+        self._index_stats[box_id] = yield io_executor.submit(
+            _write_index_file,
+            self._get_index_path(box_id),
+            self._dump_index(samples),
+        )
+
+    def _try_lock(self, box_id):
+        locks_dir = os.path.join(self.samples_root, _LOCKS_DIR)
+
+        try:
+            os.makedirs(locks_dir)
+        except OSError:
+            # made by another process
+            pass
+
+        return try_flock(os.path.join(locks_dir, box_id))
+
+    def _get_samples(self, box_id, indexed, index_mtime):
+        """
+        Returns entries of the latest history_size samples in the box
+        directory, with the records of indexed entries whose sample didn't
+        change since the index was written
+        """
 
-    def _get_samples(self, box_id):
         path = os.path.join(self.samples_root, box_id)
         samples = [sample for sample in os.listdir(path) if sample.endswith('.json')]
-        samples = [number_part_of_sample(sample) for sample in samples]
-        return sorted(samples, reverse=True)[:self.n_samples]
+        samples = sorted((number_part_of_sample(sample) for sample in samples), reverse=True)[:self.history_size]
+        records = {entry[0]: entry for entry in indexed if not isinstance(entry, int)}
+
+        return [
+            records[sample]
+            if sample in records and _get_mtime(self._get_json_path(box_id, sample)) <= index_mtime
+            else sample
+            for sample in samples
+        ]
 
     def _get_metadata(self, sample, box_id):
         return get_metadata_from_json(self._get_json_path(box_id, sample))
 
-    def _enrich_sample(self, sample, box_id):
-        return {
-            '_created': sample,
-            'date': unix_time_to_readable_date(sample),
-            'link': os.path.join(self.base_url, 'uploads', box_id, '{}.mp3'.format(sample)),
-            'metadata': self._get_metadata(sample, box_id),
-        }
-
-    def _enrich_samples(self, samples, box_id):
-        return [self._enrich_sample(sample, box_id) for sample in samples]
+    def _serialize(self, box_id, samples):
+        return [sample.serialize(box_id, self.base_url) for sample in samples]
 
     def _write_metadata(self, sample, metadata, box_id):
-        open(self._get_json_path(box_id, sample), 'w').write(json.dumps(metadata))
+        return io_executor.submit(
+            write_file_atomically,
+            self._get_json_path(box_id, sample),
+            json.dumps(metadata),
+        )
+
+    def _get_index_path(self, box_id):
+        return os.path.join(self.samples_root, box_id, _INDEX_FILE)
 
     def _get_json_path(self, box_id, sample):
         return os.path.join(self.samples_root, box_id, '{}.json'.format(sample))
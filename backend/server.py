@@ -1,12 +1,15 @@
 import logging
 import json
+import signal
 import click
-import logstash
 
 from tornado.web import Application
+from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes
 from tornado.log import enable_pretty_logging
-from upload_handler import UploadHandler
+from upload_handler import UploadHandler, UploadCheckHandler
 from clubs_handler import ClubsHandler
 from spy_handler import SpyHandler
 from health_handler import HealthHandler
@@ -15,11 +18,18 @@ from clubs import Clubs
 from bo_handler import BOHandler, BOWifiHandler
 from bo_samples_handler import BOSamplesHandler
 from token_handler import TokenHandler
-
-try:
-    from acrcloud.recognizer import ACRCloudRecognizer
-except ImportError:
-    from acrcloud_osx.recognizer import ACRCloudRecognizer
+from recognition import STRATEGIES, RecognizerStats
+from gracenote_pool import GracenotePool
+from recognition_cache import RecognitionCache
+from acrcloud_client import ACRCloudClient
+from recognition_queue import RecognitionQueue
+from metrics import StageLatencies, RequestMetrics, IOLoopLag
+from stats_handler import StatsHandler
+from metrics_handler import MetricsHandler
+from ioloop_profiler import IOLoopProfiler
+from passwords import PasswordVerifier
+from tokens import VerifiedTokens
+from log_shipper import AsyncLogstashHandler
 
 
 
@@ -28,9 +38,11 @@ except ImportError:
 @click.option('--samples-root', default='/usr/share/nginx/html/listenin.io/uploads/', help='Where files go')
 @click.option('--base-url', default='http://listenin.io/', help='Base URL')
 @click.option('--n-samples', default=10, help='How many samples to return')
+@click.option('--history-size', default=100, help='How many samples to keep per box for the back office history')
 @click.option('--sample-interval', default=4*60, help='How often should new samples come in')
 @click.option('--acr-key', required=True, help='ACRCloud Access Key')
 @click.option('--acr-secret', required=True, help='ACRCloud Access Secret')
+@click.option('--acr-connections', default=10, help='Max concurrent ACRCloud connections')
 @click.option('--es-host', default='http://localhost:9200', help='ElasticSearch host')
 @click.option('--gn-client-id', required=True, help='Gracenote cliet id')
 @click.option('--gn-user-id', required=True, help='Gracenote user id')
@@ -39,8 +51,45 @@ except ImportError:
 @click.option('--jwt-secret', required=True, help='Json Web Token secret')
 @click.option('--debug', default=False, help='Debug mode')
 @click.option('--users-file', default='users.json', help='path to users file')
-def main(port, samples_root, base_url, n_samples, sample_interval, acr_key, acr_secret, es_host, gn_client_id, gn_user_id, gn_license, images_version, jwt_secret, debug, users_file):
-    logstash_handler = logstash.LogstashHandler('localhost', 5959, version=1)
+@click.option('--max-upload-size', default=20*1024*1024, help='Max sample size in bytes')
+@click.option('--recognition-strategy', default='sequential', type=click.Choice(STRATEGIES), help='How to run the recognizers')
+@click.option('--hedge-delay', default=3.0, help='Seconds before starting the next recognizer when hedging')
+@click.option('--gn-workers', default=4, help='Number of Gracenote workers')
+@click.option('--gn-timeout', default=20, help='Seconds before a Gracenote job fails')
+@click.option('--recognition-cache-size', default=10000, help='How many recognitions to keep in memory')
+@click.option('--recognition-cache-ttl', default=7*24*60*60, help='Seconds to keep a recognition')
+@click.option('--recognition-cache-dir', default=None, help='Where to persist recognitions, not persisted if not set')
+@click.option('--recognition-cache-trusted', is_flag=True, help='Use cached recognitions without asking the recognizer again')
+@click.option('--recognition-queue-depth', default=100, help='How many samples can wait for recognition')
+@click.option('--recognition-workers', default=4, help='How many samples are recognized at once')
+@click.option('--profile-ioloop', is_flag=True, help='Log callbacks blocking the IOLoop')
+@click.option('--profile-threshold', default=0.05, help='Seconds a callback may block the IOLoop when profiling')
+@click.option('--profile-interval', default=60, help='Seconds between slow callbacks reports when profiling')
+@click.option('--bcrypt-workers', default=2, help='Number of processes checking passwords')
+@click.option('--login-cache-ttl', default=5*60, help='Seconds to remember verified credentials')
+@click.option('--login-attempts', default=5, help='Password checks allowed per user per minute')
+@click.option('--token-cache-size', default=10000, help='How many verified tokens to remember')
+@click.option('--token-cache-ttl', default=60*60, help='Seconds before a token is verified again')
+@click.option('--log-flush-interval', default=1.0, help='Seconds between logstash shipments')
+@click.option('--log-buffer-size', default=10000, help='Log events kept until shipped, newer ones are dropped')
+@click.option('--workers', default=1, help='Number of server processes, 0 for one per CPU')
+@click.option('--sync-interval', default=1.0, help='Seconds between picking up changes of other server processes')
+@click.option('--metrics-port', default=None, type=int, help='Port serving /metrics and /bo/stats of the first server process only, the next ones use the next ports')
+def main(port, samples_root, base_url, n_samples, history_size, sample_interval, acr_key, acr_secret, acr_connections, es_host, gn_client_id, gn_user_id, gn_license, images_version, jwt_secret, debug, users_file, max_upload_size, recognition_strategy, hedge_delay, gn_workers, gn_timeout, recognition_cache_size, recognition_cache_ttl, recognition_cache_dir, recognition_cache_trusted, recognition_queue_depth, recognition_workers, profile_ioloop, profile_threshold, profile_interval, bcrypt_workers, login_cache_ttl, login_attempts, token_cache_size, token_cache_ttl, log_flush_interval, log_buffer_size, workers, sync_interval, metrics_port):
+    sockets = bind_sockets(port)
+    slot = None
+
+    # everything starting threads, processes or the IOLoop comes after the fork
+    if workers != 1:
+        slot = fork_processes(workers)
+
+    logstash_handler = AsyncLogstashHandler(
+        'localhost',
+        5959,
+        capacity=log_buffer_size,
+        flush_interval=log_flush_interval,
+        version=1,
+    )
 
     logstash_logger = logging.getLogger('logstash-logger')
     logstash_logger.setLevel(logging.INFO)
@@ -49,13 +98,8 @@ def main(port, samples_root, base_url, n_samples, sample_interval, acr_key, acr_
     enable_pretty_logging()
     logstash_logger.info('Starting Server')
 
-    acr_config = {
-        'host':'eu-west-1.api.acrcloud.com',
-        'access_key': acr_key,
-        'access_secret': acr_secret,
-        'debug': False,
-        'timeout':10,
-    }
+    if profile_ioloop:
+        IOLoopProfiler(threshold=profile_threshold, dump_interval=profile_interval).install()
 
     gn_config = {
         'client_id': gn_client_id,
@@ -63,14 +107,34 @@ def main(port, samples_root, base_url, n_samples, sample_interval, acr_key, acr_
         'license': gn_license,
     }
 
-    recognizer = ACRCloudRecognizer(acr_config)
+    acrcloud = ACRCloudClient(
+        host='eu-west-1.api.acrcloud.com',
+        access_key=acr_key,
+        access_secret=acr_secret,
+        timeout=10,
+        max_connections=acr_connections,
+    )
+
+    gracenote = GracenotePool(gn_config, size=gn_workers, timeout=gn_timeout)
+    gracenote.start()
+
+    recognition_cache = RecognitionCache(
+        max_size=recognition_cache_size,
+        ttl=recognition_cache_ttl,
+        path=recognition_cache_dir,
+    )
+    recognition_cache.sync()
 
     samples_cache = SamplesCache(
         samples_root=samples_root,
         n_samples=n_samples,
         base_url=base_url,
+        history_size=history_size,
     )
 
+    # served from memory, boxes are read before taking requests
+    IOLoop.current().run_sync(samples_cache.sync)
+
     clubs = Clubs(
         samples=samples_cache,
         base_url=base_url,
@@ -82,31 +146,81 @@ def main(port, samples_root, base_url, n_samples, sample_interval, acr_key, acr_
     app = Application(
         [
             (r"/upload", UploadHandler),
+            (r"/upload/check", UploadCheckHandler),
             (r"/clubs", ClubsHandler),
             (r"/bo/samples", BOSamplesHandler),
             (r"/bo", BOHandler),
             (r"/bo/wifi", BOWifiHandler),
+            (r"/bo/stats", StatsHandler),
             (r"/token", TokenHandler),
             (r"/spy", SpyHandler),
             (r"/health", HealthHandler),
+            (r"/metrics", MetricsHandler),
         ],
         debug=debug,
         clubs=clubs,
         sample_interval=sample_interval,
         samples_root=samples_root,
+        max_upload_size=max_upload_size,
         samples=samples_cache,
-        recognizer=recognizer,
-        gn_config=gn_config,
+        acrcloud=acrcloud,
+        recognition_strategy=recognition_strategy,
+        hedge_delay=hedge_delay,
+        recognition_stats=RecognizerStats(),
+        latency=StageLatencies(),
+        request_metrics=RequestMetrics(),
+        ioloop_lag=IOLoopLag(),
+        recognition_cache=recognition_cache,
+        recognition_cache_trusted=recognition_cache_trusted,
+        gracenote=gracenote,
         jwt_secret=jwt_secret,
+        tokens=VerifiedTokens(jwt_secret, max_size=token_cache_size, ttl=token_cache_ttl),
         users=users,
+        log_shipper=logstash_handler,
+        worker=slot or 0,
+        passwords=PasswordVerifier(
+            jwt_secret,
+            workers=bcrypt_workers,
+            cache_ttl=login_cache_ttl,
+            max_attempts=login_attempts,
+        ),
+    )
+
+    # workers read the application settings
+    app.settings['recognition_queue'] = RecognitionQueue(
+        app.settings,
+        max_depth=recognition_queue_depth,
+        workers=recognition_workers,
+        slot=slot,
     )
+    app.settings['recognition_queue'].start()
+    app.settings['ioloop_lag'].start()
+
+    clubs.schedule_stops()
 
+    if slot is not None:
+        def sync():
+            samples_cache.sync()
+            clubs.sync()
+            recognition_cache.sync()
 
-    PeriodicCallback(clubs.remove_overdue_stops, 1000).start()
+        PeriodicCallback(sync, 1000 * sync_interval).start()
 
-    app.listen(port, xheaders=True)
+    # stopping the loop lets logging ship buffered events on exit
+    signal.signal(signal.SIGTERM, lambda *args: IOLoop.current().add_callback_from_signal(IOLoop.current().stop))
+
+    HTTPServer(app, xheaders=True).add_sockets(sockets)
+
+    # requests to port are served by any process, scrape each one on its own port
+    if metrics_port is not None:
+        HTTPServer(Application([
+            (r"/metrics", MetricsHandler),
+            (r"/bo/stats", StatsHandler),
+        ], **app.settings)).listen(metrics_port + (slot or 0))
     IOLoop.current().start()
 
+    clubs.journal.close()
+
 
 if __name__ == "__main__":
     main()
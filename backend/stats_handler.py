@@ -0,0 +1,22 @@
+import os
+
+from base_handler import CORSHandler
+
+
+class StatsHandler(CORSHandler):
+    """
+    Pipeline stats for admins: latency histograms per stage and box,
+    recognizers, recognition cache and queue of this server process
+    """
+
+    def get(self):
+        self.check_admin()
+
+        self.finish({
+            'worker': self.settings['worker'],
+            'pid': os.getpid(),
+            'latency': self.settings['latency'].snapshot(),
+            'recognizers': self.settings['recognition_stats'].snapshot(),
+            'recognition_cache': self.settings['recognition_cache'].stats(),
+            'recognition_queue': self.settings['recognition_queue'].stats(),
+        })
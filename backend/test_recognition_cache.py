@@ -0,0 +1,96 @@
+"""
+Recognition cache matching on synthetic recordings
+"""
+
+import unittest
+
+import numpy as np
+
+import audio_fingerprint
+from recognition_cache import RecognitionCache
+
+RATE = audio_fingerprint.RATE
+
+
+def beat(seed, seconds=30, bpm=124.0, hats_seed=None):
+    """
+    Returns a kick on every beat and hats on offbeats or sixteenths, the
+    kick timbre and the hats are random
+    """
+
+    r = np.random.RandomState(seed)
+    out = np.zeros(seconds * RATE)
+    period = 60.0 / bpm
+
+    f0, f1 = r.uniform(40, 70), r.uniform(80, 250)
+    sweep, decay = r.uniform(0.01, 0.04), r.uniform(0.05, 0.2)
+    t = np.arange(int(0.4 * RATE)) / float(RATE)
+    kick = np.exp(-t / decay) * np.sin(2 * np.pi * (f0 * t + f1 * sweep * (1 - np.exp(-t / sweep))))
+    kick[:40] += r.uniform(0, 0.3) * r.uniform(-1, 1, 40)
+
+    for k in range(int(seconds / period)):
+        i = int(k * period * RATE)
+        out[i:i + len(kick)] += kick[:len(out) - i]
+
+    if hats_seed is not None:
+        r = np.random.RandomState(hats_seed)
+
+    hat_decay, hat_gain = r.uniform(0.005, 0.03), r.uniform(0.05, 0.3)
+    step = period / r.choice([2, 4])
+    length = int(0.1 * RATE)
+
+    for k in range(int(seconds / step)):
+        if step == period / 2 and k % 2 == 0:
+            continue
+
+        i = int(k * step * RATE)
+        hat = hat_gain * np.exp(-np.arange(length) / (hat_decay * RATE)) * np.diff(r.uniform(-1, 1, length + 1))
+        out[i:i + length] += hat[:len(out) - i]
+
+    return out
+
+
+def record(track, start, seconds=20, snr_db=None):
+    """
+    Returns the fingerprint of seconds of track from start, with noise
+    snr_db under it if it's given
+    """
+
+    x = track[int(start * RATE):int((start + seconds) * RATE)]
+    x = 12000 * x / np.abs(x).max()
+
+    if snr_db is not None:
+        noise = np.random.RandomState(int(start * 1000)).normal(0, 1, len(x))
+        x = x + noise * np.sqrt((x ** 2).mean() / 10 ** (snr_db / 10.0))
+
+    return audio_fingerprint.fingerprint(np.clip(x, -32767, 32767).astype('<i2').tostring())
+
+
+class RecognitionCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = RecognitionCache(max_size=10, ttl=3600)
+        self.track = beat(1)
+        self.cache.put(record(self.track, 0), 'acrcloud', {'title': 'a'})
+
+    def test_rerecording_hits(self):
+        self.assertEqual(self.cache.get(record(self.track, 3, snr_db=10)), ('acrcloud', {'title': 'a'}))
+
+    def test_short_overlap_misses(self):
+        self.assertIsNone(self.cache.get(record(self.track, 14, snr_db=10)))
+
+    def test_other_beat_misses(self):
+        for seed in range(2, 6):
+            self.assertIsNone(self.cache.get(record(beat(seed), 0, snr_db=10)))
+
+    def test_other_hats_miss(self):
+        self.assertIsNone(self.cache.get(record(beat(1, hats_seed=50), 0, snr_db=10)))
+
+    def test_evicted_misses(self):
+        for seed in range(2, 12):
+            self.cache.put(record(beat(seed), 0), 'acrcloud', {'title': seed})
+
+        self.assertIsNone(self.cache.get(record(self.track, 3, snr_db=10)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,44 +1,48 @@
-import bcrypt
 import json
 from copy import copy
 
+from tornado.gen import coroutine, Return
 from tornado.web import HTTPError
 from base_handler import CORSHandler
-
-def check_password(plain_text_password, hashed_password):
-    return bcrypt.checkpw(
-        plain_text_password.encode('utf-8'),
-        hashed_password.encode('utf-8')
-    )
+from passwords import RateLimited
 
 
 class TokenHandler(CORSHandler):
+    @coroutine
     def _authenticate(self):
         username = self._request()['username']
         password = self._request()['password']
         user = copy(self.settings['users'].get(username))
 
-        if not check_password(password, user['hashed_password']):
+        if user is None:
+            raise HTTPError(403)
+
+        try:
+            ok = yield self.settings['passwords'].verify(username, password, user['hashed_password'])
+        except RateLimited:
+            raise HTTPError(429, reason='Too Many Requests')
+
+        if not ok:
             raise HTTPError(403)
 
         del user['hashed_password']
-        return user
+        raise Return(user)
 
     def _request(self):
         if not hasattr(self, '_req'):
             self._req = json.loads(self.request.body)
         return self._req
 
+    @coroutine
     def _create_token(self):
-        user = self._authenticate()
-
-        if user is None:
-            return
+        user = yield self._authenticate()
 
         if user.get('admin', False) and 'payload' in self._request():
-            return self.create_token(self._request()['payload'])
+            raise Return(self.create_token(self._request()['payload']))
 
-        return self.create_token(user)
+        raise Return(self.create_token(user))
 
+    @coroutine
     def post(self):
-        self.finish({'token': self._create_token()})
+        token = yield self._create_token()
+        self.finish({'token': token})
@@ -0,0 +1,36 @@
+"""
+Cache of verified JSON Web Tokens
+"""
+
+import time
+
+import jwt
+from lru import LRUTTLDict
+
+
+class VerifiedTokens(object):
+    """
+    Bounded LRU of verified token -> claims. A token is verified again
+    after ttl seconds and never outlives its exp claim, so an expired token
+    is rejected by jwt.decode as it would be without the cache.
+    """
+
+    def __init__(self, secret, max_size=10000, ttl=60*60):
+        self.secret = secret
+        self.ttl = ttl
+
+        self._claims = LRUTTLDict(max_size, ttl)
+
+    def decode(self, token):
+        try:
+            return self._claims[token]
+        except KeyError:
+            pass
+
+        claims = jwt.decode(token, self.secret, algorithms=['HS256'])
+        self._claims[token] = claims
+
+        if 'exp' in claims:
+            self._claims.expire_at(token, min(claims['exp'], time.time() + self.ttl))
+
+        return claims
@@ -5,49 +5,34 @@ import time
 import tempfile
 import subprocess
 import json
+import wave
+from cStringIO import StringIO
 
 import click
 import pygn
 
-@click.command()
-@click.option('--client-id', required=True)
-@click.option('--user-id')
-@click.option('--license', required=True)
-@click.option('--filename', required=True)
-def main(client_id, user_id, license, filename):
-    """
-    Takes media files, converts it to 44100 wav file,
-    tries to recognize it and returns metadata.
-    """
+def _musicid(client_id, license, wav_filename, wav=None):
+    c_id, tag_id = client_id.split('-')
+    res = subprocess.Popen([
+        'gracetune_musicid_stream',
+        c_id,
+        tag_id,
+        license,
+        'online',
+        wav_filename
+    ], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-    if user_id is None:
-        user_id = pygn.register(client_id)
-        click.echo('user_id: {}'.format(user_id))
-        return
+    stdout, stderr = res.communicate(wav)
 
-    with tempfile.NamedTemporaryFile(suffix='.wav') as wav:
-        subprocess.check_call(['sox', filename, '-r', '44100', wav.name])
-        c_id, tag_id = client_id.split('-')
-        res = subprocess.Popen([
-            'gracetune_musicid_stream',
-            c_id,
-            tag_id,
-            license,
-            'online',
-            wav.name
-        ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-        stdout, stderr = res.communicate()
+    try:
+        return json.loads(stdout)
+    except Exception:
+        return {'error': stderr}
 
-        try:
-            res = json.loads(stdout)
-        except Exception:
-            print(json.dumps({'error': stderr}, indent=4))
-            return
 
+def _search(client_id, user_id, res):
     if 'error' in res:
-        print(json.dumps(res, indent=4))
-        return
+        return res
 
     for _ in xrange(5):
         try:
@@ -60,12 +45,61 @@ def main(client_id, user_id, license, filename):
             )
 
             if metadata:
-                print(json.dumps(metadata, indent=4))
-                return
+                return metadata
         except Exception:
             time.sleep(0.5)
 
-    print(json.dumps({'error': 'failed to fetch song details via pygn'}, indent=4))
+    return {'error': 'failed to fetch song details via pygn'}
+
+
+def identify(client_id, user_id, license, filename):
+    """
+    Takes media file, converts it to 44100 wav file,
+    tries to recognize it and returns metadata or error.
+    """
+
+    with tempfile.NamedTemporaryFile(suffix='.wav') as wav:
+        subprocess.check_call(['sox', filename, '-r', '44100', wav.name])
+        res = _musicid(client_id, license, wav.name)
+
+    return _search(client_id, user_id, res)
+
+
+def identify_pcm(client_id, user_id, license, pcm, rate, channels):
+    """
+    Like identify() but takes 16 bit PCM, the wav is piped to
+    gracetune_musicid_stream without touching the disk.
+    """
+
+    buf = StringIO()
+    wav = wave.open(buf, 'wb')
+    wav.setnchannels(channels)
+    wav.setsampwidth(2)
+    wav.setframerate(rate)
+    wav.writeframes(pcm)
+    wav.close()
+
+    res = _musicid(client_id, license, '/dev/stdin', buf.getvalue())
+    return _search(client_id, user_id, res)
+
+
+@click.command()
+@click.option('--client-id', required=True)
+@click.option('--user-id')
+@click.option('--license', required=True)
+@click.option('--filename', required=True)
+def main(client_id, user_id, license, filename):
+    """
+    Takes media files, converts it to 44100 wav file,
+    tries to recognize it and returns metadata.
+    """
+
+    if user_id is None:
+        user_id = pygn.register(client_id)
+        click.echo('user_id: {}'.format(user_id))
+        return
+
+    print(json.dumps(identify(client_id, user_id, license, filename), indent=4))
 
 if __name__ == '__main__':
     main()
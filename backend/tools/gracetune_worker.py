@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+import sys
+import json
+
+import click
+
+from gracetune_identify import identify_pcm
+
+@click.command()
+@click.option('--client-id', required=True)
+@click.option('--user-id', required=True)
+@click.option('--license', required=True)
+def main(client_id, user_id, license):
+    """
+    Long lived gracetune_identify, reads jobs from stdin and writes
+    a json line result for each job to stdout.
+
+    job: a json line {"pcm_bytes": n, "rate": 44100, "channels": 1}
+         followed by n bytes of 16 bit PCM
+    """
+
+    for line in iter(sys.stdin.readline, ''):
+        try:
+            job = json.loads(line)
+            pcm = sys.stdin.read(job['pcm_bytes'])
+            res = identify_pcm(client_id, user_id, license, pcm, job['rate'], job['channels'])
+        except Exception as e:
+            res = {'error': '{}: {}'.format(e.__class__.__name__, e)}
+
+        sys.stdout.write(json.dumps(res) + '\n')
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -1,227 +1,134 @@
 import time
 import os
 import logging
-import json
-from shutil import copyfile
-from tempfile import NamedTemporaryFile
+import uuid
 
-from tornado.gen import coroutine, Return
-from tornado.process import Subprocess
+from tornado.gen import coroutine
+from tornado.queues import QueueFull
+from tornado.web import HTTPError, stream_request_body
 from base_handler import BaseHandler
-from utils import normalize_acrcloud_response, is_same_song, normalize_metadata
-from concurrent.futures import ThreadPoolExecutor
+from persistence import io_executor, unlink_if_exists
+from sample_processor import is_fresh, is_recognized
+from metrics import timed
 
 
-def is_recognized(sample):
+def get_skip_reason(settings, box_id):
     """
-    Determines if sample is recognized by music fingerprinting
+    Returns why a new sample from box would be ignored whatever its content, None if it wouldn't
     """
 
-    if sample is None:
-        return False
+    if settings['clubs'].is_recording_on_hold(box_id):
+        return 'recording on hold'
 
-    return sample['metadata'] is not None and 'recognized_song' in sample['metadata']
+    latest_sample = settings['samples'].latest(box_id)
 
+    if is_fresh(latest_sample, settings['sample_interval']) and is_recognized(latest_sample):
+        return 'latest sample is fresh and recognized'
 
-class UploadHandler(BaseHandler):
-    _thread_pool = ThreadPoolExecutor(4)
-
-    @coroutine
-    def _recognize_sample_with_acrcloud(self, sample_path):
-        recognizer = self.settings['recognizer'].recognize_by_file
-        res = yield self._thread_pool.submit(recognizer, sample_path, 0)
-        res = json.loads(res)
 
-        if 'metadata' not in res:
-            self.log().error('acrcloud could not recognize sample')
-            return
-
-        raise Return(res['metadata']['music'][0])
+class UploadCheckHandler(BaseHandler):
+    """
+    Lets boxes ask whether a sample is needed before recording and uploading it
+    """
 
-    @coroutine
-    def recognize_sample_with_acrcloud(self, sample_path):
-        self.log().info('trying to recognize with acrcloud')
-        recognized_song = yield self._recognize_sample_with_acrcloud(sample_path)
+    def get(self):
+        reason = get_skip_reason(self.settings, self.get_club_id())
+        self.finish({'upload': reason is None, 'reason': reason})
 
-        if recognized_song:
-            self.extra_log_args['acrcloud'] = normalize_acrcloud_response(recognized_song)
-            raise Return(recognized_song)
 
-    @coroutine
-    def _recognize_sample_with_gracenote(self, sample_path):
-        conf = self.settings['gn_config']
-        proc = Subprocess([
-            'tools/gracetune_identify.py',
-            '--client-id', conf['client_id'],
-            '--user-id', conf['user_id'],
-            '--license', conf['license'],
-            '--filename', sample_path
-            ], stdout=Subprocess.STREAM)
-
-        yield proc.wait_for_exit()
-        ret = yield proc.stdout.read_until_close()
-        raise Return(json.loads(ret))
+@stream_request_body
+class UploadHandler(BaseHandler):
+    """
+    Samples are streamed into a temporary file as they arrive, unless we
+    already know the sample will be ignored. Boxes sending Expect: 100-continue
+    get the answer before they send the body.
 
-    def log(self):
-        logger = logging.getLogger('logstash-logger')
+    Kept samples are handed to the recognition queue and answered with 202,
+    or with 503 when the queue is full.
+    """
 
-        if hasattr(self, 'extra_log_args'):
-            return logging.LoggerAdapter(logger, self.extra_log_args)
+    _tmp_file = None
 
-        return logger
-        
     @coroutine
-    def recognize_sample_with_gracenote(self, sample_path):
-        recognized_song = yield self._recognize_sample_with_gracenote(sample_path)
-
-        if 'error' in recognized_song:
-            self.log().error('gracenote: %s', recognized_song['error'])
+    def prepare(self):
+        if self.request.method != 'POST':
             return
 
-        self.extra_log_args['gracenote'] = recognized_song
-        raise Return(recognized_song)
-
-    @coroutine
-    def get_metadata(self, boxid, sample_path):
-        metadata = {
-            'hidden': False,
-            'keep_unrecognized': self.settings['clubs'].is_recognition_on_hold(boxid),
-        }
-
-        try:
-            metadata['gracenote'] = yield self.recognize_sample_with_gracenote(sample_path)
-
-            if not metadata['gracenote']:
-                metadata['acrcloud'] = yield self.recognize_sample_with_acrcloud(sample_path)
-
-        except Exception:
-            self.log().exception('recognize_sample')
-
-        metadata = {k: v for k, v in metadata.iteritems() if v is not None}
-
-        raise Return(metadata)
+        max_size = self.settings['max_upload_size']
+        self.request.connection.set_max_body_size(max_size)
 
-    def is_fresh(self, sample):
-        """
-        Checks if sample is fresh by comparing seconds since its creation to the sample
-        interval specified in settings
-        """
+        if int(self.request.headers.get('Content-Length', 0)) > max_size:
+            raise HTTPError(413)
 
-        if sample is None:
-            return False
-
-        return (int(time.time()) - sample['_created']) < self.settings['sample_interval']
-
-    def is_latest_sample_fresh_and_recognized(self, latest_sample):
-        """
-        Checks if latest sample fresh and recognized.
-        """
-
-        if self.is_fresh(latest_sample) and is_recognized(latest_sample):
-            self.log().info('latest sample is fresh and recognized')
-            return True
-
-    def is_same_song(self, latest_sample, metadata):
-        """
-        Checks if current sample is a duplicate of latest sample
-        """
-
-        if is_recognized(latest_sample) and 'recognized_song' in metadata:
-            latest_song = latest_sample['metadata']['recognized_song']
-            current_song = metadata['recognized_song']
-
-            if is_same_song(latest_song, current_song):
-                self.log().info('ignoring current sample as it is recognized as the latest sample')
-                return True
-
-    def should_replace_latest_with_current(self, latest_sample, metadata):
-        """
-        Should replace latest with current if latest sample is stale
-        or if it's fresh and unrecognized, amd current sample is recognized
-        """
+        box_id = self.get_club_id()
+        reason = get_skip_reason(self.settings, box_id)
 
-        if not self.is_fresh(latest_sample):
+        if reason is not None:
+            self.log().info('%s, ignoring sample', reason)
+            self.finish()
             return
 
-        if not is_recognized(latest_sample) and 'recognized_song' in metadata:
-            return True
-
-    def is_latest_sample_fresh_and_current_unrecognized(self, latest_sample, metadata):
-        """
-        Checks if latest sample still fresh for replacing, and that current sample is recognized
-        """
+        self.sample_id = int(time.time())
 
-        if self.is_fresh(latest_sample) and 'recognized_song' not in metadata:
-            self.log().info('latest sample still fresh and current sample unrecognized, ignoring')
-            return True
+        # The sample is written once, on the same file system as the pending
+        # samples and its final location so it's only ever renamed. Uploads
+        # of a box within a second, to any process, get their own file.
+        self.tmp_path = os.path.join(
+            self.settings['samples_root'],
+            '.tmp',
+            '{}.{}.{}.mp3'.format(box_id, self.sample_id, uuid.uuid4().hex),
+        )
 
-    @coroutine
-    def upload(self, boxid):
-        """
-        FRESH sample: a sample younger than sampling interval (i.e if we want to sample every
-        4 minutes, then a sample taken < 4 minutes ago considered fresh, otherwise it's STALE)
-
-        1. If latest sample is FRESH and it's recognized, ignore current sample.
-        2. If latest sample recognized and current sample recognized,
-           and they are the same song, ignore current sample.
-        3. if lastest sample is STALE, use current sample.
-        4. If latest sample is FRESH but not recognized:
-          4.1. If current sample recognized, it replaces the last sample
-          4.2. if current sample isn't recognized, ignore current sample
-        """
-
-        if self.settings['clubs'].is_recording_on_hold(boxid):
-            self.log().info('recording on hold, ignoring sample')
-            return
+        if not os.path.isdir(os.path.dirname(self.tmp_path)):
+            os.mkdir(os.path.dirname(self.tmp_path))
 
-        samples_dir = os.path.join(self.settings['samples_root'], boxid)
-        sample_id = int(time.time())
-        sample_path = os.path.join(samples_dir, '{}.mp3'.format(sample_id))
-        latest_sample = self.settings['samples'].latest(boxid)
+        self._tmp_file = yield io_executor.submit(open, self.tmp_path, 'wb')
+        self._receive_started = time.time()
 
-        self.extra_log_args = {
-            'boxid': boxid,
-            'sample_path': sample_path
-        }
-
-        if not os.path.isdir(samples_dir):
-            os.mkdir(samples_dir)
+    @coroutine
+    def data_received(self, chunk):
+        # chunks keep coming after we finished early in prepare()
+        if self._tmp_file is not None:
+            yield io_executor.submit(self._tmp_file.write, chunk)
 
-        if self.is_latest_sample_fresh_and_recognized(latest_sample):
+    def _discard_tmp_file(self):
+        if self._tmp_file is None:
             return
 
-        with NamedTemporaryFile(suffix='.mp3') as tmp_file:
-            tmp_file.write(self.request.body)
-            tmp_file.flush()
-
-            full_metadata = yield self.get_metadata(boxid, tmp_file.name)
-            metadata = normalize_metadata(full_metadata)
+        io_executor.submit(self._tmp_file.close)
+        io_executor.submit(unlink_if_exists, self.tmp_path)
+        self._tmp_file = None
 
-            if self.is_same_song(latest_sample, metadata):
-                return
+    def on_connection_close(self):
+        self._discard_tmp_file()
 
-            if self.is_latest_sample_fresh_and_current_unrecognized(latest_sample, metadata):
-                return
+    def on_finish(self):
+        self._discard_tmp_file()
+        super(UploadHandler, self).on_finish()
 
-            # We copy instead of moving because:
-            # 1. /tmp might be a different file system.
-            # 2. to utilize NamedTemporaryFile cleanup, if we
-            #    don't make it this far, the tmp file will be deleted.
-            #
-            # * We always create a new sample, even when replacing an old
-            #   sample because clients will access it until they refresh and get
-            #   the new one.
-            copyfile(tmp_file.name, sample_path)
-
-            if self.should_replace_latest_with_current(latest_sample, metadata):
-                self.log().info('latest sample still fresh but unrecognized, replacing with recognized')
-                self.settings['samples'].replace_latest(sample_id, full_metadata, boxid)
-            else:
-                self.log().info('adding new sample')
-                self.settings['samples'].add(sample_id, full_metadata, boxid)
+    def log(self):
+        return logging.getLogger('logstash-logger')
 
     @coroutine
     def post(self):
         box_id = self.get_club_id()
+        timings = {'receive': 1000.0 * (time.time() - self._receive_started)}
+        self.extra_log_args = {'boxid': box_id, 'timings': timings}
+
         self.log().info('upload from %s', box_id)
-        yield self.upload(box_id)
+        yield io_executor.submit(self._tmp_file.close)
+        self._tmp_file = None
+
+        try:
+            with timed(timings, 'enqueue'):
+                yield self.settings['recognition_queue'].submit(box_id, self.sample_id, self.tmp_path)
+        except QueueFull:
+            self.log().warning('recognition queue is full, rejecting sample from %s', box_id)
+            io_executor.submit(unlink_if_exists, self.tmp_path)
+            self.set_status(503)
+            self.set_header('Retry-After', self.settings['sample_interval'])
+            return
+        finally:
+            self.settings['latency'].observe(box_id, timings)
+
+        self.set_status(202)
@@ -91,6 +91,13 @@ class ListenIn(object):
 
         while True:
             try:
+                if not self.is_sample_needed():
+                    # the server answered, the box is as healthy as after an upload
+                    self.write_last_uploaded_ts()
+                    self.led.set('green')
+                    time.sleep(self.interval)
+                    continue
+
                 logging.info('waiting for audio signal')
                 self.led.set('purple')
                 r = self.record_sample()
@@ -178,6 +185,22 @@ class ListenIn(object):
     def assert_sample_is_valid(self, sample_file):
         pass
 
+    def is_sample_needed(self):
+        url = 'http://api.listenin.io/upload/check?token={}'.format(self.token)
+
+        try:
+            r = requests.get(url, timeout=10)
+            r.raise_for_status()
+            r = r.json()
+        except Exception as e:
+            logging.error('upload check failed, sampling anyway: %s: %s', e.__class__.__name__, e)
+            return True
+
+        if not r['upload']:
+            logging.info('sample not needed (%s), sleeping for %d seconds', r['reason'], self.interval)
+
+        return r['upload']
+
     def upload_sample(self, sample):
         url = 'http://api.listenin.io/upload?token={}'.format(self.token)
         requests.post(url, data=sample, timeout=60).raise_for_status()
@@ -191,7 +214,7 @@ class ListenIn(object):
 @click.option('--duration', default=20, help='Duration of each sample')
 @click.option('--interval', default=60, help='How often to take a sample')
 @click.option('--retrytime', default=10, help='How much seconds to wait before retrying on failure')
-@click.option('--last_uploaded_file', default='/var/lib/listenin-looper/last_uploaded', help='where to put last uploaded timestamp')
+@click.option('--last_uploaded_file', default='/var/lib/listenin-looper/last_uploaded', help='where to put the timestamp of the last upload or skipped upload')
 
 def main(token_file, duration, interval, retrytime, last_uploaded_file):
     token = open(token_file).read()